@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+
+import argparse
+import collections
+import concurrent.futures
+import gzip
+import hashlib
+import io
+import json
+import logging
+import os
+import posixpath
+import sys
+import tarfile
+
+
+def getlogger(name='wintriallab-box-packer'):
+    log = logging.getLogger(name)
+    log.setLevel(logging.WARNING)
+    conhandler = logging.StreamHandler()
+    conhandler.setFormatter(logging.Formatter('%(levelname)s: %(asctime)s: %(message)s'))
+    log.addHandler(conhandler)
+    return log
+
+
+log = getlogger()
+
+
+class ParallelGzipWriter:
+    """A write-only file object that gzips its input on several threads
+
+    Input is cut into fixed size chunks, and each chunk is compressed as an
+    independent gzip member; a gzip file may contain any number of members
+    back to back, and gunzip, bsdtar, and Vagrant all read them as a single
+    stream. zlib releases the GIL while compressing, so a thread pool really
+    does use every core.
+
+    Chunks that are entirely zero are not compressed again; we emit a member
+    compressed once up front. The output is the same as deflating them, so
+    this only saves CPU time; packbox() is what keeps long runs of zeroes out
+    of the box in the first place.
+
+    Compressed output is written in order and hashed on the way out, so the
+    box checksum is ready as soon as the box is, with no second pass. At most
+    2 * threads chunks are held in memory at once.
+    """
+
+    def __init__(self, fileobj, threads=None, chunksize=4 * 1024 * 1024, compresslevel=6, checksum_type='sha1'):
+        self.fileobj = fileobj
+        self.threads = threads or os.cpu_count() or 1
+        self.chunksize = chunksize
+        self.compresslevel = compresslevel
+        self.hash = hashlib.new(checksum_type)
+        self.buffer = bytearray()
+        self.pending = collections.deque()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.threads)
+        self.zerochunk = bytes(chunksize)
+        self.compressedzerochunk = self.compress(self.zerochunk)
+        self.zerochunks = 0
+        self.closed = False
+
+    def compress(self, data):
+        return gzip.compress(data, compresslevel=self.compresslevel, mtime=0)
+
+    def emit(self, compressed):
+        self.fileobj.write(compressed)
+        self.hash.update(compressed)
+
+    def drain(self, keep):
+        """Write out finished chunks, in order, until only `keep` are pending"""
+        while len(self.pending) > keep:
+            self.emit(self.pending.popleft().result())
+
+    def submit(self, chunk):
+        if chunk == self.zerochunk:
+            self.zerochunks += 1
+            future = concurrent.futures.Future()
+            future.set_result(self.compressedzerochunk)
+        else:
+            future = self.executor.submit(self.compress, chunk)
+        self.pending.append(future)
+        self.drain(2 * self.threads)
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.chunksize:
+            self.submit(bytes(self.buffer[:self.chunksize]))
+            del self.buffer[:self.chunksize]
+        return len(data)
+
+    def close(self):
+        if self.closed:
+            return
+        if self.buffer:
+            self.submit(bytes(self.buffer))
+            self.buffer = bytearray()
+        self.drain(0)
+        self.executor.shutdown()
+        self.closed = True
+        log.info(f"Reused the precompressed member for {self.zerochunks} zeroed chunks of {self.chunksize} bytes")
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+
+def dataregions(path, blocksize=1024 * 1024):
+    """Find the parts of a file that aren't zero
+
+    Returns a list of (offset, length) tuples, one per run of blocks that
+    contain anything other than zeroes; runs of zero blocks are left out.
+    """
+    regions = []
+    zeroblock = bytes(blocksize)
+    offset = 0
+    with open(path, 'rb') as infile:
+        while True:
+            block = infile.read(blocksize)
+            if not block:
+                break
+            if block != zeroblock[:len(block)]:
+                if regions and sum(regions[-1]) == offset:
+                    regions[-1] = (regions[-1][0], regions[-1][1] + len(block))
+                else:
+                    regions.append((offset, len(block)))
+            offset += len(block)
+    return regions
+
+
+class SparseMemberReader:
+    """A read-only file object over the data of a PAX GNU.sparse 1.0 tar member
+
+    The member's data is the sparse map, as decimal numbers one per line and
+    padded to a whole tar block, followed by only the data regions of the
+    file; the zero runs between them take no space in the archive. bsdtar,
+    which Vagrant uses to unpack boxes, GNU tar, and Python's tarfile all
+    restore the holes on extraction. tarfile can read these members but not
+    write them, so addsparse() builds the header itself and hands this to
+    TarFile.addfile() as the member's content.
+    """
+
+    def __init__(self, path, regions, realsize, readsize=1024 * 1024):
+        self.path = path
+        self.regions = regions
+        self.readsize = readsize
+        entries = list(regions)
+        # A trailing hole is recorded as an empty region at the end of the file
+        if not entries or sum(entries[-1]) != realsize:
+            entries.append((realsize, 0))
+        numbers = [len(entries)] + [number for entry in entries for number in entry]
+        sparsemap = ''.join(f'{number}\n' for number in numbers).encode()
+        self.sparsemap = sparsemap + bytes(-len(sparsemap) % tarfile.BLOCKSIZE)
+        self.size = len(self.sparsemap) + sum(length for offset, length in regions)
+        self.pieces = self.readpieces()
+        self.piece = b''
+        self.position = 0
+
+    def readpieces(self):
+        yield self.sparsemap
+        with open(self.path, 'rb') as infile:
+            for offset, length in self.regions:
+                infile.seek(offset)
+                while length:
+                    data = infile.read(min(length, self.readsize))
+                    if not data:
+                        raise Exception(f"{self.path} got shorter while we were reading it")
+                    length -= len(data)
+                    yield data
+
+    def read(self, size):
+        parts = []
+        while size:
+            if self.position == len(self.piece):
+                self.piece = next(self.pieces, None)
+                self.position = 0
+                if self.piece is None:
+                    self.piece = b''
+                    break
+            part = self.piece[self.position:self.position + size]
+            self.position += len(part)
+            size -= len(part)
+            parts.append(part)
+        return b''.join(parts)
+
+
+def addsparse(tar, path, arcname, regions):
+    """Add a file to a PAX tar archive as a GNU.sparse 1.0 member"""
+    realsize = os.path.getsize(path)
+    reader = SparseMemberReader(path, regions, realsize)
+    info = tar.gettarinfo(path, arcname=arcname)
+    # The header's own name is a placeholder, following GNU tar; readers that
+    # don't understand sparse members extract the raw member there instead
+    dirname, basename = posixpath.split(arcname)
+    info.name = posixpath.join(dirname, 'GNUSparseFile.0', basename)
+    info.size = reader.size
+    info.pax_headers = {
+        'GNU.sparse.major': '1',
+        'GNU.sparse.minor': '0',
+        'GNU.sparse.name': arcname,
+        'GNU.sparse.realsize': str(realsize)}
+    tar.addfile(info, fileobj=reader)
+    log.info(f"Stored {arcname} as a sparse member, skipping {realsize - sum(length for offset, length in regions)} bytes of zeroes")
+
+
+def boxmetadata(provider):
+    """The metadata.json that Vagrant requires in the root of every box"""
+    return json.dumps({'provider': provider}).encode()
+
+
+def packbox(
+        vmdir, boxfile, provider, vagrantfile=None, threads=None, chunksize=4 * 1024 * 1024, compresslevel=6,
+        sparseblocksize=1024 * 1024):
+    """Stream an exported VM directory into a gzipped Vagrant box
+
+    Freshly exported VM disks are mostly zeroes. Each file is scanned first,
+    and any file with whole blocks of zeroes in it is stored as a sparse
+    member, so the zeroes never reach the archive at all; see
+    SparseMemberReader. That costs an extra read of the file, which is much
+    cheaper than compressing what it skips.
+
+    vmdir:          a directory containing an exported VM, like packer's
+                    output-hyperv-iso directory
+    boxfile:        the path to the .box file to write
+    provider:       the Vagrant provider, like hyperv or virtualbox
+    vagrantfile:    an optional Vagrantfile to include in the box
+    sparseblocksize:    the size of the zero blocks to leave out of the box;
+                        0 stores every file in full
+
+    Returns the sha1 checksum of the resulting box.
+    """
+    with open(boxfile, 'wb') as outfile:
+        gzwriter = ParallelGzipWriter(
+            outfile, threads=threads, chunksize=chunksize, compresslevel=compresslevel)
+        # Mode 'w|' streams the archive; tarfile never seeks in the output
+        with tarfile.open(fileobj=gzwriter, mode='w|', format=tarfile.PAX_FORMAT) as tar:
+            metadata = boxmetadata(provider)
+            info = tarfile.TarInfo('metadata.json')
+            info.size = len(metadata)
+            tar.addfile(info, fileobj=io.BytesIO(metadata))
+            if vagrantfile:
+                tar.add(vagrantfile, arcname='Vagrantfile')
+            for root, dirs, files in os.walk(vmdir):
+                dirs.sort()
+                for name in sorted(files):
+                    path = os.path.join(root, name)
+                    arcname = os.path.relpath(path, vmdir).replace(os.sep, '/')
+                    log.info(f"Adding {arcname} to box")
+                    size = os.path.getsize(path)
+                    if sparseblocksize and size >= sparseblocksize and not os.path.islink(path):
+                        regions = dataregions(path, sparseblocksize)
+                        if regions != [(0, size)]:
+                            addsparse(tar, path, arcname, regions)
+                            continue
+                    tar.add(path, arcname=arcname)
+        gzwriter.close()
+    return gzwriter.hexdigest()
+
+
+def main(*args, **kwargs):
+    parser = argparse.ArgumentParser(
+        description="Package an exported VM as a Vagrant box using multithreaded compression")
+    parser.add_argument('--debug', '-d', action='store_true')
+    parser.add_argument(
+        '--threads', type=int, default=os.cpu_count(),
+        help="Number of compression threads")
+    parser.add_argument(
+        '--chunk-size', type=int, default=4,
+        help="Size in MiB of each independently compressed chunk")
+    parser.add_argument('--compression-level', type=int, default=6, choices=range(1, 10))
+    parser.add_argument(
+        '--sparse-block-size', type=int, default=1,
+        help="Size in MiB of the runs of zeroes to leave out of the box; 0 to store every file in full")
+    parser.add_argument('--vagrantfile', help="A Vagrantfile to include in the box")
+    parser.add_argument('vmdir', help="The directory containing the exported VM")
+    parser.add_argument('provider', help="The provider of the box, like hyperv or virtualbox")
+    parser.add_argument('boxfile', help="The path to the box to create")
+    parsed = parser.parse_args()
+
+    if parsed.debug:
+        log.setLevel(logging.DEBUG)
+
+    checksum = packbox(
+        parsed.vmdir, parsed.boxfile, parsed.provider,
+        vagrantfile=parsed.vagrantfile, threads=parsed.threads,
+        chunksize=parsed.chunk_size * 1024 * 1024,
+        compresslevel=parsed.compression_level,
+        sparseblocksize=parsed.sparse_block_size * 1024 * 1024)
+    print(f"sha1 {checksum} {parsed.boxfile}")
+
+
+if __name__ == '__main__':
+    sys.exit(main(*sys.argv))
@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+
+import argparse
+import base64
+import concurrent.futures
+import hashlib
+import json
+import logging
+import sys
+import threading
+
+from azure.common import AzureHttpError
+from azure.storage.blob import BlockBlobService, ContentSettings
+from azure.storage.blob.models import BlobBlock, BlockListType, PublicAccess
+
+
+def getlogger(name='wintriallab-box-uploader'):
+    log = logging.getLogger(name)
+    log.setLevel(logging.WARNING)
+    conhandler = logging.StreamHandler()
+    conhandler.setFormatter(logging.Formatter('%(levelname)s: %(asctime)s: %(message)s'))
+    log.addHandler(conhandler)
+    return log
+
+
+log = getlogger()
+
+
+# Vagrant only treats a URL as catalog metadata if it's served as JSON
+catalogcontenttype = 'application/json'
+boxcontenttype = 'application/octet-stream'
+
+
+def catalogcontentsettings():
+    """Content settings for a catalog blob; pass them on every write, which replaces the blob's properties"""
+    return ContentSettings(content_type=catalogcontenttype)
+
+
+def blockid(index, data):
+    """Generate a block ID from a block's position and content
+
+    Azure requires that every block ID in a blob is the same length, and that
+    IDs are base64 encoded. Including a hash of the content means that a block
+    left over from an interrupted upload is only reused if it is byte-for-byte
+    what we would have uploaded anyway.
+    """
+    digest = hashlib.sha256(data).hexdigest()[:32]
+    return base64.b64encode(f'{index:08d}-{digest}'.encode()).decode()
+
+
+class ParallelBlockUploader:
+    """Upload a large file to a block blob as parallel staged blocks
+
+    The file is read once, in order, so that the box checksum is computed in
+    the same pass. Each block is handed to a thread pool for upload. Reading
+    pauses whenever (maxmemory / blocksize) blocks are in flight, so no more
+    than that much of the file is held in memory at once, no matter how large
+    the box is.
+
+    Blocks that were already staged by an earlier, interrupted upload (or
+    already committed) with the same ID are skipped; see blockid().
+    """
+
+    def __init__(
+            self,
+            service,
+            container,
+            blobname,
+            blocksize=16 * 1024 * 1024,
+            maxmemory=256 * 1024 * 1024,
+            threads=8):
+        self.service = service
+        self.container = container
+        self.blobname = blobname
+        self.blocksize = blocksize
+        self.inflight = threading.BoundedSemaphore(max(1, maxmemory // blocksize))
+        self.threads = threads
+
+    def existingblocks(self):
+        """Return the IDs of blocks already present for this blob"""
+        try:
+            blocklist = self.service.get_block_list(
+                self.container, self.blobname, block_list_type=BlockListType.All)
+        except AzureHttpError as exp:
+            if exp.status_code == 404:
+                return set()
+            raise
+        blocks = blocklist.committed_blocks + blocklist.uncommitted_blocks
+        return {block.id for block in blocks}
+
+    def putblock(self, data, block_id):
+        try:
+            self.service.put_block(self.container, self.blobname, data, block_id)
+        finally:
+            self.inflight.release()
+
+    def upload(self, path, checksum_type='sha1'):
+        """Upload a file, and return its checksum"""
+        existing = self.existingblocks()
+        if existing:
+            log.info(f"Found {len(existing)} blocks already present for {self.blobname}")
+
+        checksum = hashlib.new(checksum_type)
+        blocklist = []
+        skipped = 0
+        futures = []
+        with open(path, 'rb') as infile, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=self.threads) as executor:
+            index = 0
+            while True:
+                self.inflight.acquire()
+                data = infile.read(self.blocksize)
+                if not data:
+                    self.inflight.release()
+                    break
+                checksum.update(data)
+                block_id = blockid(index, data)
+                blocklist.append(BlobBlock(id=block_id))
+                if block_id in existing:
+                    skipped += 1
+                    self.inflight.release()
+                else:
+                    futures.append(executor.submit(self.putblock, data, block_id))
+                index += 1
+                # Fail early rather than reading the rest of a 10GB file
+                for future in [f for f in futures if f.done()]:
+                    future.result()
+                    futures.remove(future)
+            for future in futures:
+                future.result()
+
+        log.info(f"Uploaded {len(blocklist) - skipped} blocks and skipped {skipped} for {self.blobname}")
+        self.service.put_block_list(
+            self.container, self.blobname, blocklist,
+            content_settings=ContentSettings(content_type=boxcontenttype))
+        return checksum.hexdigest()
+
+
+class VagrantCatalogBlob:
+    """A Vagrant catalog stored in blob storage
+
+    Uses the same format as the caryatid post-processor. Updates are
+    conditional on the blob's ETag, so two uploaders that finish at the same
+    time can't silently drop each other's versions; on a conflict we re-read
+    the catalog and apply the change again.
+    """
+
+    def __init__(self, service, container, boxname, description=''):
+        self.service = service
+        self.container = container
+        self.boxname = boxname
+        self.description = description
+        self.blobname = f'{boxname}.json'
+
+    def read(self):
+        """Return (catalog dict, etag), or a new catalog and None"""
+        try:
+            blob = self.service.get_blob_to_text(self.container, self.blobname)
+            return json.loads(blob.content), blob.properties.etag
+        except AzureHttpError as exp:
+            if exp.status_code == 404:
+                catalog = {'name': self.boxname, 'description': self.description, 'versions': []}
+                return catalog, None
+            raise
+
+    @classmethod
+    def addbox(cls, catalog, version, provider, url, checksum_type, checksum):
+        """Add a box to a catalog dict, replacing any with the same version/provider"""
+        versions = [v for v in catalog['versions'] if v['version'] == version]
+        if versions:
+            versionentry = versions[0]
+        else:
+            versionentry = {'version': version, 'providers': []}
+            catalog['versions'].append(versionentry)
+        versionentry['providers'] = [
+            p for p in versionentry['providers'] if p['name'] != provider]
+        versionentry['providers'].append({
+            'name': provider,
+            'url': url,
+            'checksum_type': checksum_type,
+            'checksum': checksum})
+        return catalog
+
+    def update(self, version, provider, url, checksum_type, checksum, retries=5):
+        for attempt in range(retries):
+            catalog, etag = self.read()
+            self.addbox(catalog, version, provider, url, checksum_type, checksum)
+            conditions = {'if_match': etag} if etag else {'if_none_match': '*'}
+            try:
+                self.service.create_blob_from_text(
+                    self.container, self.blobname, json.dumps(catalog, indent=2),
+                    content_settings=catalogcontentsettings(), **conditions)
+                log.info(f"Added {self.boxname} {version} ({provider}) to the catalog")
+                return catalog
+            except AzureHttpError as exp:
+                if exp.status_code not in [409, 412]:
+                    raise
+                log.info(f"Catalog {self.blobname} changed while we were updating it, retrying...")
+        raise Exception(f"Could not update catalog {self.blobname} after {retries} attempts")
+
+
+def boxblobname(boxname, version, provider):
+    """The blob name for a box, following the caryatid layout"""
+    return f'{boxname}/{boxname}_{version}_{provider}.box'
+
+
+def main(*args, **kwargs):
+    parser = argparse.ArgumentParser(
+        description="Upload a Vagrant box to Azure blob storage and add it to the Vagrant catalog")
+    parser.add_argument('--debug', '-d', action='store_true')
+    parser.add_argument('--storage-account-name')
+    parser.add_argument('--storage-account-key')
+    parser.add_argument(
+        '--emulated', action='store_true',
+        help="Use the local storage emulator instead of a real storage account")
+    parser.add_argument('--container', default='vagrant')
+    parser.add_argument('--description', default='')
+    parser.add_argument(
+        '--block-size', type=int, default=16,
+        help="Size of each uploaded block in MiB")
+    parser.add_argument(
+        '--max-memory', type=int, default=256,
+        help="The most memory in MiB to use for blocks waiting to be uploaded")
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('boxfile', help="The .box file to upload")
+    parser.add_argument('boxname', help="The name of the box in the catalog")
+    parser.add_argument('version', help="The version of the box")
+    parser.add_argument('provider', help="The provider of the box, like hyperv or virtualbox")
+    parsed = parser.parse_args()
+
+    if parsed.debug:
+        log.setLevel(logging.DEBUG)
+
+    if parsed.emulated:
+        service = BlockBlobService(is_emulated=True)
+    elif parsed.storage_account_name and parsed.storage_account_key:
+        service = BlockBlobService(
+            account_name=parsed.storage_account_name,
+            account_key=parsed.storage_account_key)
+    else:
+        raise Exception("Pass either --emulated or both --storage-account-name and --storage-account-key")
+
+    # Vagrant fetches the catalog and the boxes it lists with plain
+    # unauthenticated GETs, so their blobs must be publicly readable. Blob
+    # level access still doesn't let anyone list the container.
+    created = service.create_container(
+        parsed.container, public_access=PublicAccess.Blob, fail_on_exist=False)
+    if not created:
+        public_access = service.get_container_acl(parsed.container).public_access
+        if public_access not in (PublicAccess.Blob, PublicAccess.Container):
+            log.warning(
+                f"Container '{parsed.container}' is private, so Vagrant will not be able to download from it; "
+                "set its public access level to 'Blob'")
+
+    blobname = boxblobname(parsed.boxname, parsed.version, parsed.provider)
+    uploader = ParallelBlockUploader(
+        service, parsed.container, blobname,
+        blocksize=parsed.block_size * 1024 * 1024,
+        maxmemory=parsed.max_memory * 1024 * 1024,
+        threads=parsed.threads)
+    checksum = uploader.upload(parsed.boxfile)
+
+    catalog = VagrantCatalogBlob(service, parsed.container, parsed.boxname, parsed.description)
+    catalog.update(
+        parsed.version, parsed.provider,
+        service.make_blob_url(parsed.container, blobname),
+        'sha1', checksum)
+    log.info(f"Catalog URL: {service.make_blob_url(parsed.container, catalog.blobname)}")
+
+
+if __name__ == '__main__':
+    sys.exit(main(*sys.argv))
@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+
+import argparse
+import collections
+import csv
+import datetime
+import json
+import logging
+import os
+import re
+import statistics
+import sys
+
+
+def getlogger(name='wintriallab-build-profiler'):
+    log = logging.getLogger(name)
+    log.setLevel(logging.WARNING)
+    conhandler = logging.StreamHandler()
+    conhandler.setFormatter(logging.Formatter('%(levelname)s: %(asctime)s: %(message)s'))
+    log.addHandler(conhandler)
+    return log
+
+
+log = getlogger()
+
+
+# Messages logged by Invoke-BuildStep and Invoke-ExpressionEx in
+# scripts/wintriallab-postinstall.psm1. Each pattern maps to a step name
+# prefix and whether the message starts, finishes, or fails a step.
+steppatterns = [
+    (re.compile(r"^Build step '(?P<name>.*)' started"), '', 'start'),
+    (re.compile(r"^Build step '(?P<name>.*)' finished"), '', 'end'),
+    (re.compile(r"^Build step '(?P<name>.*)' failed"), '', 'fail'),
+    (re.compile(r"^Invoke-ExpressionEx called to run command '(?P<name>.*?)'\r?\n", re.S), 'Invoke-ExpressionEx: ', 'start'),
+    (re.compile(r"^Expression '(?P<name>.*?)' exited with code", re.S), 'Invoke-ExpressionEx: ', 'end'),
+    (re.compile(r"^Invoke-ExpressionEx failed to run command '(?P<name>.*?)'", re.S), 'Invoke-ExpressionEx: ', 'fail'),
+]
+
+
+# Different export methods name the same fields differently:
+# Log Analytics search results, Get-WinEvent, and Get-EventLog respectively
+fieldaliases = {
+    'time': ['TimeGenerated', 'TimeCreated', 'TimeWritten'],
+    'message': ['RenderedDescription', 'Message'],
+    'computer': ['Computer', 'MachineName'],
+}
+
+
+Event = collections.namedtuple('Event', ['time', 'computer', 'message'])
+Step = collections.namedtuple('Step', ['name', 'start', 'end', 'duration', 'depth', 'status'])
+
+
+def parsetime(value):
+    """Parse the many ways a timestamp comes out of an event log export"""
+    # ConvertTo-Json in Windows PowerShell writes DateTimes like "/Date(1504267200000)/"
+    match = re.match(r'^\\?/Date\((?P<ms>-?\d+)\)\\?/$', value)
+    if match:
+        return datetime.datetime.utcfromtimestamp(int(match.group('ms')) / 1000)
+    value = re.sub(r'(\.\d{6})\d+', r'\1', value.strip())
+    for informat in [
+            '%Y-%m-%dT%H:%M:%S.%fZ', '%Y-%m-%dT%H:%M:%SZ',
+            '%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S',
+            '%Y-%m-%d %H:%M:%S', '%m/%d/%Y %I:%M:%S %p', '%m/%d/%Y %H:%M:%S']:
+        try:
+            return datetime.datetime.strptime(value, informat)
+        except ValueError:
+            pass
+    raise Exception(f"Could not parse timestamp '{value}'")
+
+
+def getfield(record, field):
+    for alias in fieldaliases[field]:
+        if record.get(alias) is not None:
+            return record[alias]
+    return None
+
+
+def normalizeevent(record):
+    """Convert an exported event record to an Event, or None if it has no timestamp"""
+    time = getfield(record, 'time')
+    if time is None:
+        return None
+    return Event(parsetime(str(time)), getfield(record, 'computer') or '', getfield(record, 'message') or '')
+
+
+def loadrecords(path):
+    """Load event records from a saved log file
+
+    Understands JSON (a list of records, Log Analytics search results with a
+    'value' key, or one record per line) and CSV from Export-Csv.
+    """
+    with open(path, encoding='utf-8-sig') as logfile:
+        content = logfile.read()
+    if path.lower().endswith('.csv'):
+        lines = [line for line in content.splitlines(True) if not line.startswith('#TYPE')]
+        return list(csv.DictReader(lines))
+    try:
+        data = json.loads(content)
+    except json.JSONDecodeError:
+        return [json.loads(line) for line in content.splitlines() if line.strip()]
+    if isinstance(data, dict):
+        data = data.get('value', [data])
+    return data
+
+
+def loadbuilds(paths):
+    """Load saved log files into a dict of {build name: [Event, ...]}
+
+    Each file is one build, named after the file. If a file contains events
+    from more than one computer, each computer is a separate build.
+    """
+    builds = collections.OrderedDict()
+    for path in paths:
+        stem = os.path.splitext(os.path.basename(path))[0]
+        events = [e for e in map(normalizeevent, loadrecords(path)) if e]
+        computers = sorted({e.computer for e in events})
+        for computer in computers:
+            name = f'{stem}:{computer}' if len(computers) > 1 else stem
+            builds[name] = [e for e in events if e.computer == computer]
+    return builds
+
+
+def classify(message):
+    """Return (step name, 'start'|'end'|'fail') for a step event, or None"""
+    for pattern, prefix, kind in steppatterns:
+        match = pattern.match(message)
+        if match:
+            return prefix + ' '.join(match.group('name').split()), kind
+    return None
+
+
+def pairsteps(events):
+    """Pair start and end events into a list of Steps, ordered by start time
+
+    Steps may nest (an Invoke-ExpressionEx call inside Install-SevenZip, for
+    instance); depth counts how many other steps were open when one started.
+    A step that never finished is reported as incomplete, ending at the last
+    event in the log.
+    """
+    events = sorted(events, key=lambda e: e.time)
+    opensteps = []
+    steps = []
+    for event in events:
+        classified = classify(event.message)
+        if not classified:
+            continue
+        name, kind = classified
+        if kind == 'start':
+            opensteps.append((name, event.time, len(opensteps)))
+            continue
+        for index in range(len(opensteps) - 1, -1, -1):
+            if opensteps[index][0] == name:
+                _, start, depth = opensteps.pop(index)
+                status = 'ok' if kind == 'end' else 'failed'
+                steps.append(Step(name, start, event.time, (event.time - start).total_seconds(), depth, status))
+                break
+        else:
+            log.debug(f"Found an end event for step '{name}' with no matching start")
+    if events:
+        for name, start, depth in opensteps:
+            steps.append(Step(name, start, events[-1].time, (events[-1].time - start).total_seconds(), depth, 'incomplete'))
+    return sorted(steps, key=lambda s: (s.start, s.depth))
+
+
+def criticalpath(steps, events):
+    """Summarize where a build's wall time went
+
+    Provisioning runs one step at a time, so the critical path is simply the
+    sequence of top level steps, plus the untracked gaps between them.
+    """
+    if not events:
+        return {'wall': 0, 'tracked': 0, 'path': []}
+    first = min(e.time for e in events)
+    last = max(e.time for e in events)
+    wall = (last - first).total_seconds()
+    path = []
+    cursor = first
+    for step in [s for s in steps if s.depth == 0]:
+        gap = (step.start - cursor).total_seconds()
+        if gap > 0:
+            path.append({'name': '(untracked)', 'duration': gap})
+        path.append({'name': step.name, 'duration': step.duration, 'status': step.status})
+        cursor = max(cursor, step.end)
+    tracked = sum(p['duration'] for p in path if p['name'] != '(untracked)')
+    for item in path:
+        item['share'] = item['duration'] / wall if wall else 0
+    return {'start': first.isoformat(), 'wall': wall, 'tracked': tracked, 'path': path}
+
+
+def regressions(profiles, threshold=0.2, minseconds=30):
+    """Compare the latest build's step durations to the median of earlier builds
+
+    profiles:   a list of (build name, {step name: total seconds}) tuples,
+                oldest build first
+    threshold:  flag steps that got slower than this fraction of the baseline
+    minseconds: ...and by more than this many seconds
+    """
+    if len(profiles) < 2:
+        return []
+    latestname, latest = profiles[-1]
+    report = []
+    for name in sorted(set(latest) | {n for _, p in profiles[:-1] for n in p}):
+        history = [p[name] for _, p in profiles[:-1] if name in p]
+        baseline = statistics.median(history) if history else None
+        current = latest.get(name)
+        if baseline is None:
+            status = 'new'
+        elif current is None:
+            status = 'missing'
+        elif current - baseline > minseconds and current > baseline * (1 + threshold):
+            status = 'regressed'
+        elif baseline - current > minseconds and current < baseline * (1 - threshold):
+            status = 'improved'
+        else:
+            status = 'unchanged'
+        report.append({
+            'step': name, 'baseline': baseline, 'latest': current,
+            'delta': (current - baseline) if None not in (current, baseline) else None,
+            'status': status})
+    return report
+
+
+def profile(builds, threshold=0.2, minseconds=30):
+    """Build the full report for a dict of {build name: [Event, ...]}"""
+    report = {'builds': [], 'regressions': []}
+    totals = []
+    for name, events in builds.items():
+        steps = pairsteps(events)
+        pathinfo = criticalpath(steps, events)
+        durations = collections.defaultdict(float)
+        for step in steps:
+            durations[step.name] += step.duration
+        report['builds'].append({
+            'build': name,
+            'criticalpath': pathinfo,
+            'steps': [
+                dict(s._asdict(), start=s.start.isoformat(), end=s.end.isoformat())
+                for s in steps]})
+        totals.append((pathinfo.get('start', ''), name, dict(durations)))
+    totals.sort()
+    report['regressions'] = regressions(
+        [(name, durations) for _, name, durations in totals], threshold, minseconds)
+    if len(totals) > 1:
+        report['baseline'] = [name for _, name, _ in totals[:-1]]
+        report['latest'] = totals[-1][1]
+    return report
+
+
+def formatseconds(seconds):
+    if seconds is None:
+        return '-'
+    sign = '-' if seconds < 0 else ''
+    minutes, seconds = divmod(int(round(abs(seconds))), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f'{sign}{hours}:{minutes:02d}:{seconds:02d}'
+
+
+def formatreport(report, width=60):
+    """Format a report as plain text tables"""
+    lines = []
+    for build in report['builds']:
+        path = build['criticalpath']
+        lines.append(f"Build {build['build']}: wall time {formatseconds(path['wall'])}, tracked {formatseconds(path['tracked'])}")
+        for item in path['path']:
+            status = '' if item.get('status', 'ok') == 'ok' else f" ({item['status']})"
+            lines.append(f"    {formatseconds(item['duration']):>10} {item['share']:6.1%}  {item['name'][:width]}{status}")
+        lines.append('')
+    if report['regressions']:
+        lines.append(f"Latest build {report['latest']} compared to the median of {len(report['baseline'])} earlier build(s):")
+        lines.append(f"    {'baseline':>10} {'latest':>10} {'delta':>10}  {'status':<10} step")
+        for item in sorted(report['regressions'], key=lambda i: -(i['delta'] or 0)):
+            lines.append(
+                f"    {formatseconds(item['baseline']):>10} {formatseconds(item['latest']):>10} "
+                f"{formatseconds(item['delta']):>10}  {item['status']:<10} {item['step'][:width]}")
+    return '\n'.join(lines)
+
+
+def main(*args, **kwargs):
+    parser = argparse.ArgumentParser(
+        description="Report how long each build step took, from saved WinTrialLab event logs")
+    parser.add_argument('--debug', '-d', action='store_true')
+    parser.add_argument('--json', help="Also write the full report as JSON to this path")
+    parser.add_argument(
+        '--threshold', type=float, default=0.2,
+        help="Flag steps more than this fraction slower than in earlier builds")
+    parser.add_argument(
+        '--min-seconds', type=float, default=30,
+        help="Ignore changes smaller than this many seconds")
+    parser.add_argument(
+        'logs', nargs='+',
+        help="Saved event logs, one per build, as JSON (e.g. from Get-WinEvent | ConvertTo-Json, or Log Analytics search results) or CSV (from Get-EventLog | Export-Csv)")
+    parsed = parser.parse_args()
+
+    if parsed.debug:
+        log.setLevel(logging.DEBUG)
+
+    report = profile(loadbuilds(parsed.logs), parsed.threshold, parsed.min_seconds)
+    print(formatreport(report))
+    if parsed.json:
+        with open(parsed.json, 'w') as jf:
+            json.dump(report, jf, indent=2)
+
+
+if __name__ == '__main__':
+    sys.exit(main(*sys.argv))
@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+
+import argparse
+import collections
+import csv
+import json
+import logging
+import os
+import sys
+
+
+def getlogger(name='wintriallab-capacity-planner'):
+    log = logging.getLogger(name)
+    log.setLevel(logging.WARNING)
+    conhandler = logging.StreamHandler()
+    conhandler.setFormatter(logging.Formatter('%(levelname)s: %(asctime)s: %(message)s'))
+    log.addHandler(conhandler)
+    return log
+
+
+log = getlogger()
+
+
+VmSize = collections.namedtuple('VmSize', ['name', 'cores', 'memory', 'price'])
+Build = collections.namedtuple('Build', ['name', 'cores', 'memory', 'hours'])
+
+
+# Only Dv3 and Ev3 sizes support nested virtualization. Memory is in MB, and
+# prices are approximate hourly pay-as-you-go rates for Windows VMs in
+# westus2; pass --sizes with a CSV of current prices for real planning.
+defaultsizes = [
+    VmSize('Standard_D2_v3', 2, 8192, 0.188),
+    VmSize('Standard_D4_v3', 4, 16384, 0.376),
+    VmSize('Standard_D8_v3', 8, 32768, 0.752),
+    VmSize('Standard_D16_v3', 16, 65536, 1.504),
+    VmSize('Standard_D32_v3', 32, 131072, 3.008),
+    VmSize('Standard_D64_v3', 64, 262144, 6.016),
+    VmSize('Standard_E2_v3', 2, 16384, 0.226),
+    VmSize('Standard_E4_v3', 4, 32768, 0.452),
+    VmSize('Standard_E8_v3', 8, 65536, 0.904),
+    VmSize('Standard_E16_v3', 16, 131072, 1.808),
+    VmSize('Standard_E32_v3', 32, 262144, 3.616),
+    VmSize('Standard_E64_v3', 64, 442368, 7.232),
+]
+
+
+def loadsizes(path):
+    """Load VM sizes from a CSV file with name, cores, memory (MB), and price (per hour) columns"""
+    with open(path) as sf:
+        return [
+            VmSize(row['name'], int(row['cores']), int(row['memory']), float(row['price']))
+            for row in csv.DictReader(sf)]
+
+
+def packerfileresources(path, buildertype='hyperv-iso'):
+    """Return (box name, cores, memory in MB) for one builder in a packerfile
+
+    Hyper-V builders declare ram_size and cpu directly; VirtualBox builders
+    declare them as vboxmanage modifyvm arguments. Missing values get
+    packer's defaults.
+    """
+    with open(path) as pf:
+        packerfile = json.load(pf)
+    name = packerfile.get('variables', {}).get('boxname') or os.path.basename(os.path.dirname(os.path.realpath(path)))
+    builders = [b for b in packerfile.get('builders', []) if b.get('type') == buildertype]
+    if not builders:
+        raise Exception(f"No '{buildertype}' builder in packerfile '{path}'")
+    builder = builders[0]
+    if buildertype.startswith('virtualbox'):
+        cores, memory = 1, 512
+        for command in builder.get('vboxmanage', []):
+            arguments = [str(a) for a in command]
+            if '--cpus' in arguments:
+                cores = int(arguments[arguments.index('--cpus') + 1])
+            if '--memory' in arguments:
+                memory = int(arguments[arguments.index('--memory') + 1])
+    else:
+        cores = int(builder.get('cpu', 1))
+        memory = int(builder.get('ram_size', 1024))
+    return name, cores, memory
+
+
+def simulate(builds, size, reservedcores=0, reservedmemory=2048):
+    """Schedule builds on a single builder VM, and return (makespan, schedule)
+
+    Builds run concurrently as long as the sum of their cores and memory fits
+    within the VM, less what the host itself needs. Builds are started
+    longest first, whenever enough resources are free.
+
+    Returns the makespan in hours, and a list of (build, start, end) tuples.
+    """
+    cores = size.cores - reservedcores
+    memory = size.memory - reservedmemory
+    waiting = sorted(builds, key=lambda b: -b.hours)
+    running = []
+    schedule = []
+    now = 0.0
+    while waiting or running:
+        usedcores = sum(b.cores for b, _ in running)
+        usedmemory = sum(b.memory for b, _ in running)
+        for build in list(waiting):
+            if usedcores + build.cores <= cores and usedmemory + build.memory <= memory:
+                waiting.remove(build)
+                running.append((build, now + build.hours))
+                schedule.append((build, now, now + build.hours))
+                usedcores += build.cores
+                usedmemory += build.memory
+        if not running:
+            raise Exception(f"Build '{waiting[0].name}' does not fit on a {size.name}")
+        now = min(end for _, end in running)
+        running = [(b, end) for b, end in running if end > now]
+    return now, schedule
+
+
+def fits(build, size, reservedcores=0, reservedmemory=2048):
+    return build.cores <= size.cores - reservedcores and build.memory <= size.memory - reservedmemory
+
+
+class CapacityPlanner:
+    """Plan a fleet of builder VMs that builds every box before a deadline
+
+    For each eligible VM size, and for each fleet size from 1 VM up to one
+    VM per build, assign builds longest first to whichever VM would finish
+    soonest with it. Keep the cheapest fleet that meets the deadline, using
+    makespan to break ties. Then try to shrink each VM in that fleet to the
+    cheapest size that still finishes its own builds by the deadline, so the
+    final plan may mix sizes.
+
+    Cost is each VM's hourly price times how long it runs, including
+    setuphours for deploying the VM and installing packer and Hyper-V.
+    """
+
+    def __init__(self, sizes, deadline, setuphours=0.5, reservedcores=0, reservedmemory=2048):
+        self.sizes = sizes
+        self.deadline = deadline
+        self.setuphours = setuphours
+        self.reservedcores = reservedcores
+        self.reservedmemory = reservedmemory
+
+    def simulate(self, builds, size):
+        return simulate(builds, size, self.reservedcores, self.reservedmemory)
+
+    def cost(self, size, makespan):
+        return size.price * (makespan + self.setuphours)
+
+    def assign(self, builds, size, count):
+        """Assign builds to `count` VMs of one size; return a list of build lists"""
+        fleet = [[] for _ in range(count)]
+        makespans = [0.0] * count
+        for build in sorted(builds, key=lambda b: -b.hours):
+            best = None
+            for index in range(count):
+                makespan, _ = self.simulate(fleet[index] + [build], size)
+                if best is None or makespan < best[0]:
+                    best = (makespan, index)
+            fleet[best[1]].append(build)
+            makespans[best[1]] = best[0]
+        return [vm for vm in fleet if vm]
+
+    def evaluate(self, fleet):
+        """Return a plan dict for a list of (size, builds) pairs"""
+        vms = []
+        for size, builds in fleet:
+            makespan, schedule = self.simulate(builds, size)
+            vms.append({
+                'size': size.name,
+                'cores': size.cores,
+                'memory': size.memory,
+                'makespan': makespan,
+                'cost': self.cost(size, makespan),
+                'builds': [
+                    {'name': b.name, 'start': start, 'end': end}
+                    for b, start, end in sorted(schedule, key=lambda s: s[1])]})
+        makespan = max(vm['makespan'] for vm in vms) + self.setuphours
+        return {
+            'builders': vms,
+            'cost': sum(vm['cost'] for vm in vms),
+            'makespan': makespan,
+            'meetsdeadline': makespan <= self.deadline}
+
+    def shrink(self, fleet):
+        """Move each VM to the cheapest size that still meets the deadline"""
+        shrunk = []
+        for size, builds in fleet:
+            candidates = [
+                s for s in self.sizes
+                if all(fits(b, s, self.reservedcores, self.reservedmemory) for b in builds)]
+            best = (self.cost(size, self.simulate(builds, size)[0]), size)
+            for candidate in candidates:
+                makespan, _ = self.simulate(builds, candidate)
+                if makespan + self.setuphours <= self.deadline and self.cost(candidate, makespan) < best[0]:
+                    best = (self.cost(candidate, makespan), candidate)
+            shrunk.append((best[1], builds))
+        return shrunk
+
+    def plan(self, builds):
+        if not builds:
+            raise Exception("Nothing to build")
+        best = None
+        fastest = None
+        for size in self.sizes:
+            if not all(fits(b, size, self.reservedcores, self.reservedmemory) for b in builds):
+                log.debug(f"Skipping {size.name}, which is too small for at least one build")
+                continue
+            for count in range(1, len(builds) + 1):
+                fleet = [(size, vm) for vm in self.assign(builds, size, count)]
+                plan = self.evaluate(fleet)
+                key = (plan['cost'], plan['makespan'])
+                if fastest is None or (plan['makespan'], plan['cost']) < (fastest[1]['makespan'], fastest[1]['cost']):
+                    fastest = (fleet, plan)
+                if plan['meetsdeadline'] and (best is None or key < (best[1]['cost'], best[1]['makespan'])):
+                    best = (fleet, plan)
+                # More VMs can't help once every build has a VM to itself
+                if len(fleet) < count:
+                    break
+        if fastest is None:
+            raise Exception("No eligible VM size is large enough for every build")
+        if best is None:
+            log.warning(f"No plan meets the {self.deadline} hour deadline; returning the fastest plan instead")
+            return fastest[1]
+        return self.evaluate(self.shrink(best[0]))
+
+
+def formatplan(plan):
+    lines = [
+        f"{len(plan['builders'])} builder VM(s), estimated cost ${plan['cost']:.2f}, "
+        f"finishing after {plan['makespan']:.2f} hours"
+        + ("" if plan['meetsdeadline'] else " (MISSES THE DEADLINE)")]
+    for index, vm in enumerate(plan['builders']):
+        lines.append(f"  builder {index}: {vm['size']} ({vm['cores']} cores, {vm['memory']} MB), {vm['makespan']:.2f} hours, ${vm['cost']:.2f}")
+        for build in vm['builds']:
+            lines.append(f"    {build['start']:6.2f} - {build['end']:6.2f}h  {build['name']}")
+    return '\n'.join(lines)
+
+
+def main(*args, **kwargs):
+    parser = argparse.ArgumentParser(
+        description="Plan how many builder VMs, of which sizes, to deploy to build a set of boxes before a deadline")
+    parser.add_argument('--debug', '-d', action='store_true')
+    parser.add_argument(
+        '--sizes', help="A CSV file of eligible VM sizes with name, cores, memory (MB), and price (per hour) columns. Defaults to the Dv3 and Ev3 sizes.")
+    parser.add_argument('--deadline', type=float, default=24, help="Hours until every build must be finished")
+    parser.add_argument(
+        '--durations',
+        help="A JSON file mapping box names to expected build times in hours")
+    parser.add_argument('--default-hours', type=float, default=4, help="Expected build time for boxes not in --durations")
+    parser.add_argument('--setup-hours', type=float, default=0.5, help="Time to deploy and configure each builder VM")
+    parser.add_argument('--reserved-cores', type=int, default=0, help="Cores to leave free for the builder VM itself")
+    parser.add_argument('--reserved-memory', type=int, default=2048, help="Memory in MB to leave free for the builder VM itself")
+    parser.add_argument('--builder-type', default='hyperv-iso', help="The packer builder to read resources from")
+    parser.add_argument('--json', help="Also write the plan as JSON to this path")
+    parser.add_argument('packerfiles', nargs='+', help="Packerfiles for the boxes to build")
+    parsed = parser.parse_args()
+
+    if parsed.debug:
+        log.setLevel(logging.DEBUG)
+
+    sizes = loadsizes(parsed.sizes) if parsed.sizes else defaultsizes
+    durations = {}
+    if parsed.durations:
+        with open(parsed.durations) as df:
+            durations = json.load(df)
+
+    builds = []
+    for packerfile in parsed.packerfiles:
+        name, cores, memory = packerfileresources(packerfile, parsed.builder_type)
+        builds.append(Build(name, cores, memory, durations.get(name, parsed.default_hours)))
+
+    planner = CapacityPlanner(
+        sizes, parsed.deadline, setuphours=parsed.setup_hours,
+        reservedcores=parsed.reserved_cores, reservedmemory=parsed.reserved_memory)
+    plan = planner.plan(builds)
+    print(formatplan(plan))
+    if parsed.json:
+        with open(parsed.json, 'w') as jf:
+            json.dump(plan, jf, indent=2)
+    return 0 if plan['meetsdeadline'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(*sys.argv))
@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+
+import argparse
+import bisect
+import collections
+import concurrent.futures
+import datetime
+import json
+import logging
+import os
+import re
+import sys
+import urllib.parse
+import urllib.request
+
+
+def getlogger(name='wintriallab-catalog-pruner'):
+    log = logging.getLogger(name)
+    log.setLevel(logging.WARNING)
+    conhandler = logging.StreamHandler()
+    conhandler.setFormatter(logging.Formatter('%(levelname)s: %(asctime)s: %(message)s'))
+    log.addHandler(conhandler)
+    return log
+
+
+log = getlogger()
+
+
+# Our packerfiles set versions like "1.0.{{isotime \"20060102150405\"}}"
+versionregex = re.compile(r'^\d+\.\d+\.(?P<isotime>\d{14})$')
+
+
+def builddate(version):
+    """Parse the build date out of a box version
+
+    Return None for a version that doesn't follow our scheme; we never prune
+    those, since we can't tell how old they are.
+    """
+    match = versionregex.match(version)
+    if not match:
+        return None
+    return datetime.datetime.strptime(match.group('isotime'), '%Y%m%d%H%M%S')
+
+
+def urlpath(url):
+    """Convert a file:// URL to a local path"""
+    parsed = urllib.parse.urlparse(url)
+    path = urllib.request.url2pathname(parsed.path)
+    # file:///C:/whatever on Windows has a leading slash we need to remove
+    if re.match(r'^[/\\][A-Za-z]:', path):
+        path = path[1:]
+    return path
+
+
+class LocalCatalogStore:
+    """A caryatid catalog on the local filesystem, with file:// box URLs"""
+
+    def __init__(self, path):
+        self.path = path
+        self.name = path
+
+    def read(self):
+        with open(self.path) as cf:
+            return json.load(cf)
+
+    def write(self, catalog):
+        """Write the catalog atomically, so Vagrant never sees half of it"""
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as cf:
+            json.dump(catalog, cf, indent=2)
+        os.replace(tmp, self.path)
+
+    def size(self, url):
+        return os.stat(urlpath(url)).st_size
+
+    def delete(self, url):
+        os.remove(urlpath(url))
+
+    def truncate(self, url):
+        open(urlpath(url), 'w').close()
+
+
+class BlobCatalogStore:
+    """A catalog uploaded by boxupload.py to Azure blob storage"""
+
+    def __init__(self, service, container, boxname):
+        from boxupload import VagrantCatalogBlob
+        self.service = service
+        self.container = container
+        self.catalogblob = VagrantCatalogBlob(service, container, boxname)
+        self.name = f'{container}/{self.catalogblob.blobname}'
+        self.etag = None
+
+    def blobname(self, url):
+        prefix = self.service.make_blob_url(self.container, '')
+        if not url.startswith(prefix):
+            raise Exception(f"Box URL '{url}' is not in container '{self.container}'")
+        return urllib.parse.unquote(url[len(prefix):])
+
+    def read(self):
+        catalog, self.etag = self.catalogblob.read()
+        return catalog
+
+    def write(self, catalog):
+        from boxupload import catalogcontentsettings
+        # Fails rather than clobbering an upload that finished after we read
+        self.service.create_blob_from_text(
+            self.container, self.catalogblob.blobname,
+            json.dumps(catalog, indent=2), content_settings=catalogcontentsettings(),
+            if_match=self.etag)
+
+    def boxblob(self, method, url, *args, **kwargs):
+        """Call a blob service method on a box's blob, raising FileNotFoundError if it's gone"""
+        from azure.common import AzureHttpError
+        try:
+            return method(self.container, self.blobname(url), *args, **kwargs)
+        except AzureHttpError as exp:
+            if exp.status_code == 404:
+                raise FileNotFoundError(f"No such blob '{url}'")
+            raise
+
+    def size(self, url):
+        properties = self.boxblob(self.service.get_blob_properties, url)
+        return properties.properties.content_length
+
+    def delete(self, url):
+        self.boxblob(self.service.delete_blob, url)
+
+    def truncate(self, url):
+        from azure.storage.blob import ContentSettings
+        from boxupload import boxcontenttype
+        # Writing the blob replaces its properties, so keep its content type
+        self.boxblob(
+            self.service.create_blob_from_bytes, url, b'',
+            content_settings=ContentSettings(content_type=boxcontenttype))
+
+
+BoxVersion = collections.namedtuple('BoxVersion', ['builddate', 'version', 'entry'])
+
+
+class CatalogIndex:
+    """An index of the versions in one or more catalogs
+
+    Versions are grouped by box name and sorted by build date, so each
+    retention policy is a slice or a bisect rather than a scan. Building the
+    index only reads the catalog JSON; box files themselves are only touched
+    when we decide to delete them.
+    """
+
+    def __init__(self):
+        self.boxes = collections.defaultdict(list)
+        self.unparseable = collections.defaultdict(list)
+
+    def add(self, catalog):
+        name = catalog['name']
+        for entry in catalog.get('versions', []):
+            date = builddate(entry['version'])
+            if date is None:
+                self.unparseable[name].append(entry['version'])
+            else:
+                self.boxes[name].append(BoxVersion(date, entry['version'], entry))
+        self.boxes[name].sort(key=lambda v: v.builddate)
+        if self.unparseable[name]:
+            log.warning(f"Ignoring versions of {name} that have no build date: {self.unparseable[name]}")
+
+    def expired(self, name, cutoff):
+        """Versions of a box built before the cutoff"""
+        versions = self.boxes[name]
+        dates = [v.builddate for v in versions]
+        return versions[:bisect.bisect_left(dates, cutoff)]
+
+    def beyondlast(self, name, keep):
+        """Versions of a box older than the newest `keep` versions"""
+        versions = self.boxes[name]
+        return versions[:max(0, len(versions) - keep)]
+
+    def prunable(self, name, keeplast=None, maxage=None, now=None):
+        """Versions of a box that violate any retention policy
+
+        The newest version is never pruned, so that `vagrant up` for a box
+        keeps working even if it hasn't been rebuilt in a while.
+        """
+        now = now or datetime.datetime.utcnow()
+        prune = set()
+        if keeplast is not None:
+            prune.update(v.version for v in self.beyondlast(name, max(1, keeplast)))
+        if maxage is not None:
+            prune.update(v.version for v in self.expired(name, now - maxage))
+        if self.boxes[name]:
+            prune.discard(self.boxes[name][-1].version)
+        return [v for v in self.boxes[name] if v.version in prune]
+
+
+class CatalogPruner:
+    """Apply retention policies to a catalog and delete the pruned boxes
+
+    The catalog is rewritten once, before any box is deleted, so a failure
+    partway through leaves orphaned box files rather than a catalog pointing
+    at boxes that no longer exist. Box files are then deleted concurrently.
+    Once the catalog no longer lists a box, no later run will find it, so
+    one box failing doesn't stop the others from being removed; a box that
+    is already gone counts as 0 bytes reclaimed.
+    """
+
+    def __init__(self, store, threads=8, tombstone=False, dryrun=False):
+        self.store = store
+        self.threads = threads
+        self.tombstone = tombstone
+        self.dryrun = dryrun
+
+    def removebox(self, url):
+        """Remove a single box file, and return the number of bytes reclaimed"""
+        try:
+            size = self.store.size(url)
+            if self.dryrun:
+                log.info(f"Would remove {url} ({size} bytes)")
+            elif self.tombstone:
+                self.store.truncate(url)
+                log.info(f"Truncated {url} ({size} bytes)")
+            else:
+                self.store.delete(url)
+                log.info(f"Deleted {url} ({size} bytes)")
+        except FileNotFoundError:
+            log.warning(f"{url} was already gone")
+            return 0
+        return size
+
+    def prune(self, keeplast=None, maxage=None):
+        """Prune the catalog
+
+        Returns a tuple of (list of pruned versions, bytes reclaimed, list of
+        (box URL, exception) tuples for boxes that could not be removed).
+        """
+        catalog = self.store.read()
+        index = CatalogIndex()
+        index.add(catalog)
+        pruned = index.prunable(catalog['name'], keeplast=keeplast, maxage=maxage)
+        if not pruned:
+            return [], 0, []
+
+        # With tombstones, Vagrant can still see the old versions exist
+        if not self.dryrun and not self.tombstone:
+            prunedversions = {v.version for v in pruned}
+            catalog['versions'] = [
+                v for v in catalog['versions'] if v['version'] not in prunedversions]
+            self.store.write(catalog)
+
+        urls = [p['url'] for v in pruned for p in v.entry.get('providers', [])]
+        reclaimed = 0
+        errors = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.threads) as executor:
+            futures = {executor.submit(self.removebox, url): url for url in urls}
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    reclaimed += future.result()
+                except Exception as exp:
+                    log.error(f"Could not remove {futures[future]}: {exp}")
+                    errors.append((futures[future], exp))
+        return [v.version for v in pruned], reclaimed, errors
+
+
+def main(*args, **kwargs):
+    parser = argparse.ArgumentParser(
+        description="Delete old and expired boxes from Vagrant catalogs")
+    parser.add_argument('--debug', '-d', action='store_true')
+    parser.add_argument(
+        '--keep-last', type=int,
+        help="Keep only this many of the most recent versions of each box")
+    parser.add_argument(
+        '--max-age-days', type=int, default=90,
+        help="Prune versions built more than this many days ago. Windows evaluation versions expire after 90 or 180 days, depending on the edition.")
+    parser.add_argument(
+        '--tombstone', action='store_true',
+        help="Replace pruned boxes with empty files and leave them in the catalog, rather than deleting them")
+    parser.add_argument(
+        '--dry-run', action='store_true', help="Report what would be pruned, but don't change anything")
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument(
+        '--container',
+        help="Treat catalogs as box names in this blob storage container, rather than local paths")
+    parser.add_argument('--storage-account-name')
+    parser.add_argument('--storage-account-key')
+    parser.add_argument('--emulated', action='store_true')
+    parser.add_argument('catalogs', nargs='+', help="Catalog paths, or box names with --container")
+    parsed = parser.parse_args()
+
+    if parsed.debug:
+        log.setLevel(logging.DEBUG)
+
+    if parsed.container:
+        from azure.storage.blob import BlockBlobService
+        if parsed.emulated:
+            service = BlockBlobService(is_emulated=True)
+        else:
+            service = BlockBlobService(
+                account_name=parsed.storage_account_name,
+                account_key=parsed.storage_account_key)
+        stores = [BlobCatalogStore(service, parsed.container, c) for c in parsed.catalogs]
+    else:
+        stores = [LocalCatalogStore(c) for c in parsed.catalogs]
+
+    maxage = datetime.timedelta(days=parsed.max_age_days) if parsed.max_age_days else None
+    total = 0
+    errors = []
+    for store in stores:
+        pruner = CatalogPruner(
+            store, threads=parsed.threads, tombstone=parsed.tombstone, dryrun=parsed.dry_run)
+        try:
+            versions, reclaimed, boxerrors = pruner.prune(keeplast=parsed.keep_last, maxage=maxage)
+        except Exception as exp:
+            log.error(f"Could not prune {store.name}: {exp}")
+            errors.append((store.name, exp))
+            continue
+        total += reclaimed
+        errors += boxerrors
+        print(f"{store.name}: pruned {len(versions)} versions, reclaimed {reclaimed} bytes")
+        for version in versions:
+            print(f"    {version}")
+    print(f"Reclaimed {total} bytes in total")
+
+    if errors:
+        print(f"{len(errors)} errors:")
+        for name, exp in errors:
+            print(f"    {name}: {exp}")
+        return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(*sys.argv))
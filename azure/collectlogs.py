@@ -0,0 +1,396 @@
+#!/usr/bin/env python3
+
+import argparse
+import base64
+import concurrent.futures
+import json
+import logging
+import os
+import queue
+import re
+import sys
+import threading
+
+import readiness
+
+
+def getlogger(name='wintriallab-log-collector'):
+    log = logging.getLogger(name)
+    log.setLevel(logging.WARNING)
+    conhandler = logging.StreamHandler()
+    conhandler.setFormatter(logging.Formatter('%(levelname)s: %(asctime)s: %(message)s'))
+    log.addHandler(conhandler)
+    return log
+
+
+log = getlogger()
+
+
+# The CustomScriptExtension logs to C:\Packages\Plugins; the Azure agent logs to C:\WindowsAzure\Logs
+defaultdirectories = [r'C:\Packages\Plugins', r'C:\WindowsAzure\Logs']
+
+# deployInit.ps1 logs to the WinTrialLab event log, and DSC logs to its own
+defaulteventlogs = ['WinTrialLab', 'Microsoft-Windows-DSC/Operational']
+
+# Where event logs are exported to on the remote host before we fetch them
+remoteexportdir = r'C:\Windows\Temp\wintriallab-collectlogs'
+
+# .NET DateTime ticks (100ns since 0001-01-01) at the Unix epoch
+epochticks = 621355968000000000
+
+
+def psquote(value):
+    """Quote a string as a single-quoted PowerShell literal"""
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+class WinRMShell:
+    """A single open WinRM shell on a remote host
+
+    Opening a shell costs a few round trips, so we keep it open and run
+    every command through it, rather than using winrm.Session.run_ps(),
+    which opens and closes a new shell for each command. Each command still
+    starts its own PowerShell process, so callers should do as much as they
+    can per command; stream_ps() lets a single command return a whole file.
+    """
+
+    def __init__(self, host, username, password, transport='ntlm', https=False):
+        import winrm.protocol
+        scheme, port = ('https', 5986) if https else ('http', 5985)
+        self.protocol = winrm.protocol.Protocol(
+            endpoint=f'{scheme}://{host}:{port}/wsman',
+            transport=transport,
+            username=username,
+            password=password,
+            server_cert_validation='ignore')
+        self.shell_id = self.protocol.open_shell()
+
+    def run_ps(self, script):
+        """Run a PowerShell script; return (stdout bytes, stderr bytes, exit code)"""
+        encoded = base64.b64encode(script.encode('utf_16_le')).decode('ascii')
+        command_id = self.protocol.run_command(
+            self.shell_id, 'powershell.exe',
+            ['-NoProfile', '-NonInteractive', '-EncodedCommand', encoded])
+        try:
+            return self.protocol.get_command_output(self.shell_id, command_id)
+        finally:
+            self.protocol.cleanup_command(self.shell_id, command_id)
+
+    def stream_ps(self, script):
+        """Run a PowerShell script, yielding its stdout as it arrives
+
+        Raises an exception once the output is exhausted if the script failed.
+        """
+        import winrm.exceptions
+        # pywinrm 0.5 made the single-receive method public
+        receive = getattr(self.protocol, 'get_command_output_raw', None) or self.protocol._raw_get_command_output
+        encoded = base64.b64encode(script.encode('utf_16_le')).decode('ascii')
+        command_id = self.protocol.run_command(
+            self.shell_id, 'powershell.exe',
+            ['-NoProfile', '-NonInteractive', '-EncodedCommand', encoded])
+        try:
+            stderr = b''
+            done = False
+            while not done:
+                try:
+                    stdout, moreerr, status, done = receive(self.shell_id, command_id)
+                except winrm.exceptions.WinRMOperationTimeoutError:
+                    # The command is still running, but had nothing to say yet
+                    continue
+                stderr += moreerr
+                if stdout:
+                    yield stdout
+            if status != 0:
+                raise Exception(f"Remote command failed with exit code {status}: {stderr.decode(errors='replace').strip()}")
+        finally:
+            self.protocol.cleanup_command(self.shell_id, command_id)
+
+    def close(self):
+        self.protocol.close_shell(self.shell_id)
+
+
+class ShellPool:
+    """A bounded pool of open shells to one host
+
+    shellfactory:   a callable returning a new shell; anything with
+                    run_ps(script), stream_ps(script), and close() methods
+                    like WinRMShell will do, which is how the collector can
+                    be pointed at a local stand-in
+    """
+
+    def __init__(self, shellfactory, size=4):
+        self.shellfactory = shellfactory
+        self.size = size
+        self.idle = queue.LifoQueue()
+        self.created = 0
+        self.lock = threading.Lock()
+        self.shells = []
+
+    def acquire(self):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            if self.created < self.size:
+                self.created += 1
+                create = True
+            else:
+                create = False
+        if not create:
+            return self.idle.get()
+        try:
+            shell = self.shellfactory()
+        except Exception:
+            with self.lock:
+                self.created -= 1
+            raise
+        with self.lock:
+            self.shells.append(shell)
+        return shell
+
+    def release(self, shell):
+        self.idle.put(shell)
+
+    def run_ps(self, script):
+        shell = self.acquire()
+        try:
+            stdout, stderr, status = shell.run_ps(script)
+        finally:
+            self.release(shell)
+        if status != 0:
+            raise Exception(f"Remote command failed with exit code {status}: {stderr.decode(errors='replace').strip()}")
+        return stdout
+
+    def stream_ps(self, script):
+        """Run a script on one shell, yielding its stdout; the shell is busy until the output is consumed"""
+        shell = self.acquire()
+        try:
+            yield from shell.stream_ps(script)
+        finally:
+            self.release(shell)
+
+    def close(self):
+        for shell in self.shells:
+            try:
+                shell.close()
+            except Exception as exp:
+                log.debug(f"Failed to close shell: {exp}")
+
+
+class HostLogCollector:
+    """Collect log directories and event log exports from one host"""
+
+    def __init__(self, pool, destination, chunksize=512 * 1024):
+        self.pool = pool
+        self.destination = destination
+        self.chunksize = chunksize
+
+    def exporteventlogs(self, eventlogs):
+        """Export event logs to .evtx files on the remote host; return their directory"""
+        commands = [f"New-Item -ItemType Directory -Force -Path {psquote(remoteexportdir)} | Out-Null"]
+        for eventlog in eventlogs:
+            exportpath = remoteexportdir + '\\' + re.sub(r'[\\/:*?"<>|]', '_', eventlog) + '.evtx'
+            # Not every log exists on every host; don't fail the rest because of one
+            commands.append(
+                f"& wevtutil.exe epl {psquote(eventlog)} {psquote(exportpath)} /ow:true 2>&1 | Out-Null")
+        commands.append("exit 0")
+        self.pool.run_ps('\n'.join(commands))
+        return remoteexportdir
+
+    def listfiles(self, directories):
+        """Return a list of (remote path, length, mtime) for every file under the directories
+
+        mtime is the file's last write time, in nanoseconds since the epoch.
+        """
+        script = '\n'.join([
+            "$ErrorActionPreference = 'Stop'",
+            f"$paths = @({', '.join(psquote(d) for d in directories)}) | Where-Object {{ Test-Path -LiteralPath $_ }}",
+            "$files = @(Get-ChildItem -LiteralPath $paths -Recurse -Force -ErrorAction SilentlyContinue | Where-Object { -not $_.PSIsContainer })",
+            "ConvertTo-Json -Compress -InputObject @($files | ForEach-Object { @{ Path = $_.FullName; Length = $_.Length; LastWriteTicks = $_.LastWriteTimeUtc.Ticks } })"])
+        output = self.pool.run_ps(script).decode('utf-8-sig').strip()
+        if not output:
+            return []
+        files = json.loads(output)
+        if isinstance(files, dict):
+            files = [files]
+        return [
+            (f['Path'], int(f['Length']), (int(f['LastWriteTicks']) - epochticks) * 100)
+            for f in files]
+
+    def localpath(self, remotepath):
+        """Map a remote path like C:\\Packages\\x.log to <destination>/C/Packages/x.log"""
+        parts = [p for p in re.split(r'[\\/]', remotepath.replace(':', '')) if p]
+        return os.path.join(self.destination, *parts)
+
+    def readchunks(self, remotepath, length):
+        """Stream the first length bytes of a remote file, yielding decoded chunks
+
+        A single PowerShell process reads the whole file and writes it to
+        stdout as one line of base64 per chunk, and we decode each line as
+        soon as it has arrived in full.
+        """
+        script = '\n'.join([
+            "$ErrorActionPreference = 'Stop'",
+            # Share mode ReadWrite so we can read logs that are still being written
+            f"$stream = [IO.File]::Open({psquote(remotepath)}, 'Open', 'Read', 'ReadWrite')",
+            "try {",
+            f"    $buffer = New-Object byte[] {self.chunksize}",
+            f"    $remaining = {length}",
+            "    while ($remaining -gt 0) {",
+            "        $read = $stream.Read($buffer, 0, [Math]::Min($buffer.Length, $remaining))",
+            "        if ($read -le 0) { break }",
+            "        [Console]::Out.WriteLine([Convert]::ToBase64String($buffer, 0, $read))",
+            "        [Console]::Out.Flush()",
+            "        $remaining -= $read",
+            "    }",
+            "}",
+            "finally { $stream.Close() }"])
+        pending = b''
+        for output in self.pool.stream_ps(script):
+            pending += output
+            *lines, pending = pending.split(b'\n')
+            for line in lines:
+                if line.strip():
+                    yield base64.b64decode(line.strip())
+        if pending.strip():
+            yield base64.b64decode(pending.strip())
+
+    def fetchfile(self, remotepath, length, mtime):
+        """Stream a remote file to disk; return bytes transferred
+
+        The local copy gets the remote file's last write time, and files that
+        already exist locally with the same length and last write time are
+        skipped, so collecting from the same host twice only fetches what
+        changed. Length alone isn't enough: event log exports grow in 64KiB
+        steps, and are rewritten on every run.
+        """
+        localpath = self.localpath(remotepath)
+        if os.path.exists(localpath):
+            stat = os.stat(localpath)
+            if stat.st_size == length and stat.st_mtime_ns == mtime:
+                log.debug(f"Skipping {remotepath}, which we already have")
+                return 0
+        os.makedirs(os.path.dirname(localpath), exist_ok=True)
+        transferred = 0
+        with open(localpath + '.partial', 'wb') as localfile:
+            for chunk in self.readchunks(remotepath, length):
+                localfile.write(chunk)
+                transferred += len(chunk)
+        os.utime(localpath + '.partial', ns=(mtime, mtime))
+        os.replace(localpath + '.partial', localpath)
+        log.info(f"Fetched {remotepath} ({transferred} bytes)")
+        return transferred
+
+
+def collect(hosts, shellfactory, destination, directories, eventlogs, poolsize=4, threads=16, chunksize=512 * 1024):
+    """Collect logs from many hosts concurrently
+
+    hosts:          a list of host names or addresses
+    shellfactory:   a callable that takes a host and returns a new shell
+    destination:    files are written under <destination>/<host>/
+
+    Returns a dict of {host: (files fetched, bytes transferred, error or None)}.
+    """
+    pools = {host: ShellPool(lambda host=host: shellfactory(host), poolsize) for host in hosts}
+    collectors = {
+        host: HostLogCollector(pools[host], os.path.join(destination, host), chunksize)
+        for host in hosts}
+    results = {}
+
+    def listhost(host):
+        collector = collectors[host]
+        exportdir = collector.exporteventlogs(eventlogs) if eventlogs else None
+        return collector.listfiles(directories + ([exportdir] if exportdir else []))
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+            listings = {host: executor.submit(listhost, host) for host in hosts}
+            fetches = {}
+            for host, listing in listings.items():
+                try:
+                    files = listing.result()
+                except Exception as exp:
+                    log.error(f"Could not list logs on {host}: {exp}")
+                    results[host] = (0, 0, exp)
+                    continue
+                fetches[host] = [
+                    executor.submit(collectors[host].fetchfile, remotepath, length, mtime)
+                    for remotepath, length, mtime in files]
+            for host, futures in fetches.items():
+                count, transferred, error = 0, 0, None
+                for future in futures:
+                    try:
+                        transferred += future.result()
+                        count += 1
+                    except Exception as exp:
+                        log.error(f"Failed to fetch a file from {host}: {exp}")
+                        error = exp
+                results[host] = (count, transferred, error)
+    finally:
+        for pool in pools.values():
+            pool.close()
+    return results
+
+
+def main(*args, **kwargs):
+    parser = argparse.ArgumentParser(
+        description="Collect log files and event logs from cloud builder VMs over WinRM")
+    parser.add_argument('--debug', '-d', action='store_true')
+    parser.add_argument(
+        '--conninfo', '-c',
+        help="A JSON file containing builderConnectionInformation deployment output(s), or '-' for stdin")
+    parser.add_argument('--username', help="Remote username, for hosts passed on the command line")
+    parser.add_argument('--password', help="Remote password, for hosts passed on the command line")
+    parser.add_argument('--https', action='store_true', help="Connect to WinRM over HTTPS on port 5986")
+    parser.add_argument('--transport', default='ntlm', help="The pywinrm authentication transport")
+    parser.add_argument(
+        '--directory', action='append',
+        help=f"A remote directory to collect. May be passed more than once. Defaults to {defaultdirectories}.")
+    parser.add_argument(
+        '--event-log', action='append',
+        help=f"An event log to export and collect. May be passed more than once. Defaults to {defaulteventlogs}.")
+    parser.add_argument('--pool-size', type=int, default=4, help="WinRM shells to keep open per host")
+    parser.add_argument('--threads', type=int, default=16, help="Files to transfer at once, across all hosts")
+    parser.add_argument('--chunk-size', type=int, default=512, help="Size of each chunk the remote side reads and sends, in KiB")
+    parser.add_argument(
+        '--outdir', default='.',
+        help="Logs are saved under <outdir>/<deployment name>/<host>/")
+    parser.add_argument('--deployment-name', default='wintriallab', help="The name of the deployment the hosts belong to")
+    parser.add_argument('hosts', nargs='*', help="Hostnames or IP addresses to collect from")
+    parsed = parser.parse_args()
+
+    if parsed.debug:
+        log.setLevel(logging.DEBUG)
+
+    credentials = {}
+    if parsed.conninfo:
+        for conninfo in readiness.loadconninfo(parsed.conninfo):
+            credentials[conninfo['IPAddress']] = (conninfo['Username'], conninfo['Password'])
+    for host in parsed.hosts:
+        if not (parsed.username and parsed.password):
+            raise Exception("Pass --username and --password for hosts passed on the command line")
+        credentials[host] = (parsed.username, parsed.password)
+    if not credentials:
+        raise Exception("Pass at least one host, or a --conninfo file")
+
+    def shellfactory(host):
+        username, password = credentials[host]
+        return WinRMShell(host, username, password, transport=parsed.transport, https=parsed.https)
+
+    destination = os.path.join(parsed.outdir, parsed.deployment_name)
+    results = collect(
+        list(credentials), shellfactory, destination,
+        parsed.directory or defaultdirectories,
+        parsed.event_log or defaulteventlogs,
+        poolsize=parsed.pool_size, threads=parsed.threads,
+        chunksize=parsed.chunk_size * 1024)
+
+    for host, (count, transferred, error) in results.items():
+        status = f"FAILED: {error}" if error else "OK"
+        print(f"{host}: fetched {count} files, {transferred} bytes, into {os.path.join(destination, host)}: {status}")
+    return 1 if any(error for _, _, error in results.values()) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(*sys.argv))
@@ -12,7 +12,9 @@ import secrets
 import string
 import sys
 import textwrap
+import threading
 import time
+import urllib.parse
 import urllib.request
 
 import requests
@@ -23,6 +25,9 @@ from azure.common.credentials import ServicePrincipalCredentials
 from azure.mgmt.resource import ResourceManagementClient
 from msrestazure.azure_exceptions import CloudError
 
+import deployservice
+import eventstore
+
 scriptdir = os.path.dirname(os.path.realpath(__file__))
 
 
@@ -108,7 +113,7 @@ class QualifiedPath:
 
     @classmethod
     def resolve(cls, path):
-        os.path.realpath(os.path.normpath(os.path.expanduser(path)))
+        return os.path.realpath(os.path.normpath(os.path.expanduser(path)))
 
     @classmethod
     def Resolved(self, mustexist=False):
@@ -120,7 +125,7 @@ class QualifiedPath:
                 '-p', type=QualifiedPath.Resolved(mustexist=True))
         """
         def r(path):
-            p = QualifiedPath(path)
+            p = QualifiedPath(path).path
             if mustexist and not os.path.exists(p):
                 raise Exception(f'Path at "{p}" does not exist')
             return p
@@ -149,7 +154,7 @@ class ComposableUri:
 
     @property
     def uri(self):
-        q = '?' + urllib.encode(self.query) if self.query else ""
+        q = '?' + urllib.parse.urlencode(self.query) if self.query else ""
         p = '/' + '/'.join(self.path)
         f = '#' + self.fragment if self.fragment else ""
         uri = f'{self.scheme}://{self.netloc}{p}{q}{f}'
@@ -177,6 +182,9 @@ class AzureLogAnalyticsClient:
             'https://login.microsoftonline.com/' + tenant_id)
         self.application_id = application_id
         self.application_key = application_key
+        self._token = None
+        self._token_expires = 0
+        self._token_lock = threading.Lock()
 
         # self.endpoint = f'https://management.azure.com/subscriptions/{subscription_id}/resourcegroups/{self.resource_group}/providers/Microsoft.OperationalInsights/workspaces/{self.workspace_name}/search'
         self.endpoint = ComposableUri(
@@ -194,21 +202,26 @@ class AzureLogAnalyticsClient:
     def access_token(self):
         """Get an access token from the authentication context API
 
-        Not clear how long this lasts, so I made it get a new one for each
-        query... if it lasts long enough, consider refactoring to just get set
-        in the constructor.
+        Tokens last about an hour, so we reuse one until shortly before it
+        expires; this matters for the deploy service, which keeps this
+        client around between queries.
         """
-        token_response = self.authcontext.acquire_token_with_client_credentials(
-            'https://management.core.windows.net/',
-            self.application_id, self.application_key)
-        return token_response.get('accessToken')
+        with self._token_lock:
+            if not self._token or time.monotonic() > self._token_expires:
+                token_response = self.authcontext.acquire_token_with_client_credentials(
+                    'https://management.core.windows.net/',
+                    self.application_id, self.application_key)
+                self._token = token_response.get('accessToken')
+                self._token_expires = time.monotonic() + int(token_response.get('expiresIn', 0)) - 300
+            return self._token
 
     def query(
             self,
             query,
             num_results=100,
-            end_time=datetime.datetime.utcnow(),
-            start_time=None):
+            end_time=None,
+            start_time=None,
+            withtotal=False):
         """Run a query against the web API
 
         query:          A query string
@@ -216,10 +229,16 @@ class AzureLogAnalyticsClient:
         start_time:     Find events no earlier than this
                         If unset, default to 24 hours before end_time
         end_time:       Find events no later than this
+                        If unset, default to now
+        withtotal:      If True, return a tuple of (results, total), where
+                        total is how many records matched in all; if it is
+                        more than len(results), the results were truncated
         """
 
         # Unfortunately, you cannot set a parameter based on the value from
         # another parameter, so we set the default here
+        if not end_time:
+            end_time = datetime.datetime.utcnow()
         if not start_time:
             start_time = end_time - datetime.timedelta(hours=24)
 
@@ -255,13 +274,15 @@ class AzureLogAnalyticsClient:
             log.info(response.status_code)
             response.raise_for_status()
 
-        log.verbose(textwrap.dedent("""
+        log.debug(textwrap.dedent(f"""
             Search request successful!
-            Total records:" + str(data["__metadata"]["total"]))
-            Returned top:" + str(data["__metadata"]["top"]))
+            Total records: {data["__metadata"]["total"]}
+            Returned top: {data["__metadata"]["top"]}
             Value:
             {data["value"]}
             """))
+        if withtotal:
+            return data["value"], int(data["__metadata"]["total"])
         return data["value"]
 
 
@@ -330,23 +351,29 @@ class WinTrialLabAzureWrapper:
         aren't started until we want to actually use them.
         """
         if not self._armclient:
-            self._armclient = ResourceManagementClient(
-                ServicePrincipalCredentials(
-                    client_id=self.service_principal_id,
-                    secret=self.service_principal_key,
-                    tenant=self.tenant_id),
-                self.subscription_id)
+            self._armclient = self.newarmclient()
         return self._armclient
 
     @property
     def loganalytics(self):
         if not self._loganalytics:
-            self._loganalytics = AzureLogAnalyticsClient(
-                self.subscription_id, self.tenant_id, self.application_id,
-                self.application_key, self.resource_group_name,
-                self.opinsights_workspace_name)
+            self._loganalytics = self.newloganalytics()
         return self._loganalytics
 
+    def newarmclient(self):
+        return ResourceManagementClient(
+            ServicePrincipalCredentials(
+                client_id=self.service_principal_id,
+                secret=self.service_principal_key,
+                tenant=self.tenant_id),
+            self.subscription_id)
+
+    def newloganalytics(self):
+        return AzureLogAnalyticsClient(
+            self.subscription_id, self.tenant_id, self.service_principal_id,
+            self.service_principal_key, self.resource_group_name,
+            self.opinsights_workspace_name)
+
     def testdeployed(self, name):
         """Test whether a resource group exists"""
         try:
@@ -367,6 +394,63 @@ class WinTrialLabAzureWrapper:
         else:
             log.info(f"The {name} resource group could not be deleted because it did not exist")
 
+    def deployments(self, groupname):
+        """Return a list of (start time, name) tuples for a resource group's deployments
+
+        ARM only records when a deployment finished (or last changed), and
+        everything the VMs log during the deployment comes before that, so
+        work back from its duration to when it started.
+        """
+        result = []
+        for d in self.armclient.deployments.list_by_resource_group(groupname):
+            start = d.properties.timestamp
+            if d.properties.duration:
+                start -= eventstore.parseduration(d.properties.duration)
+            result.append((start, d.name))
+        return result
+
+    def syncevents(self, store, query, num_results=5000, max_age_days=7):
+        """Copy event records from the Log Analytics workspace to a local EventStore
+
+        Only fetches records newer than the newest one already in the store
+        for this resource group (with a little overlap, since records can
+        show up in the workspace out of order; duplicates are ignored).
+        Workspace retention is 7 days, so there's no point looking further
+        back than that.
+
+        The API returns at most num_results records per query, so a time
+        window with more records than that is split in half until each half
+        fits. Windows are saved oldest first, so if a sync fails partway, the
+        next one doesn't skip past the windows it never got to.
+
+        store:      an eventstore.EventStore
+        query:      a Log Analytics query that returns event records
+        """
+        end_time = datetime.datetime.utcnow()
+        start_time = end_time - datetime.timedelta(days=max_age_days)
+        latest = store.latest(self.resource_group_name)
+        if latest:
+            start_time = max(start_time, latest - datetime.timedelta(hours=1))
+        deployments = self.deployments(self.resource_group_name)
+
+        added = 0
+        windows = [(start_time, end_time)]
+        while windows:
+            start, end = windows.pop()
+            records, total = self.loganalytics.query(
+                query, num_results=num_results, start_time=start, end_time=end, withtotal=True)
+            if total > len(records):
+                # The API takes times to the second, so we can't split windows any finer
+                if end - start >= datetime.timedelta(seconds=2):
+                    middle = (start + (end - start) / 2).replace(microsecond=0)
+                    log.info(f"Got {len(records)} of {total} records from {start} to {end}; splitting at {middle}")
+                    # Pop the older half first
+                    windows += [(middle, end), (start, middle)]
+                    continue
+                log.warning(f"Only got {len(records)} of {total} records from {start} to {end}; the rest were skipped")
+            added += store.ingest(records, self.resource_group_name, deployments=deployments)
+        return added
+
     def deploytempl(
             self,
             groupname,
@@ -414,6 +498,170 @@ class WinTrialLabAzureWrapper:
             return result.properties.outputs
 
 
+class AzureClientCache:
+    """Authenticated Azure clients, shared between jobs in the deploy service
+
+    Tenant IDs never change, so they are kept forever. Other clients are
+    rebuilt after maxage seconds, so that a long-running service doesn't
+    hold on to credentials whose tokens have expired.
+    """
+
+    def __init__(self, maxage=45 * 60):
+        self.maxage = maxage
+        self.lock = threading.Lock()
+        self.clients = {}
+
+    def get(self, key, factory, maxage=None):
+        """Return a cached client, or create one by calling factory()
+
+        Creating a client may block on an API call, so it happens outside the
+        lock; if two jobs race to create the same client, the last one wins.
+        """
+        with self.lock:
+            cached = self.clients.get(key)
+        if cached and (maxage is None or time.monotonic() - cached[0] < maxage):
+            return cached[1]
+        client = factory()
+        with self.lock:
+            self.clients[key] = (time.monotonic(), client)
+        return client
+
+
+class CachedWinTrialLabAzureWrapper(WinTrialLabAzureWrapper):
+    """A WinTrialLabAzureWrapper that takes its clients from an AzureClientCache"""
+
+    def __init__(self, cache, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cache = cache
+
+    @property
+    def credkey(self):
+        return (self.service_principal_id, self.service_principal_key, self.tenant_name, self.subscription_id)
+
+    @property
+    def tenant_id(self):
+        return self.cache.get(('tenant', self.tenant_name), lambda: self.tname2tid(self.tenant_name))
+
+    @property
+    def armclient(self):
+        return self.cache.get(('arm',) + self.credkey, self.newarmclient, self.cache.maxage)
+
+    @property
+    def loganalytics(self):
+        key = ('loganalytics',) + self.credkey + (self.resource_group_name, self.opinsights_workspace_name)
+        return self.cache.get(key, self.newloganalytics, self.cache.maxage)
+
+
+def loadtemplate(path):
+    """Load the YAML template; return it as a JSON string and as a dict"""
+    with open(path) as tf:
+        # Convert to JSON first to ensure that the template we see from
+        # convertyaml is exactly what Azure sees
+        json_template = json.dumps(yaml.load(tf, Loader=yaml.SafeLoader), indent=2)
+        return json_template, json.loads(json_template)
+
+
+def runjob(config, wtlazwrapper, template):
+    """Run one of the Azure actions, and return its result
+
+    Shared by main() and the deploy service, so config.action must be one of
+    ProcessedDeployConfig.serviceactions.
+    """
+    if config.action == 'testgroup':
+        return wtlazwrapper.testdeployed(config.resource_group_name)
+    elif config.action == 'delete':
+        wtlazwrapper.deletegroup(config.resource_group_name)
+    elif config.action == 'deploy' or config.action == 'validate':
+        # Log this here in case the template doesn't deploy completely, but the VM is still up and we can connect to it for debugging
+        log.debug(f"Using builder VM password '{config.builder_vm_admin_password}'")
+        return wtlazwrapper.deploytempl(
+            config.resource_group_name,
+            config.resource_group_location,
+            template,
+            {
+                'storageAccountName':       config.storage_account_name,
+                'opInsightsWorkspaceName':  config.opinsights_workspace_name,
+                'builderVmAdminUsername':   config.builder_vm_admin_username,
+                'builderVmAdminPassword':   config.builder_vm_admin_password,
+                'builderVmSize':            config.builder_vm_size,
+                'builderVmTimeZone':        config.builder_vm_timezone,
+            },
+            config.deployment_name,
+            deletefirst=config.delete,
+            validate=(config.action == 'validate'))
+    elif config.action == 'log':
+        return wtlazwrapper.loganalytics.query(config.query)
+    elif config.action == 'logsync':
+        store = eventstore.EventStore(config.event_store)
+        try:
+            return wtlazwrapper.syncevents(store, config.logsync_query)
+        finally:
+            store.close()
+    else:
+        raise Exception(f"I don't know how to process an action called '{config.action}'")
+
+
+class DeployService:
+    """Run deploy.py actions submitted over HTTP, with warm Azure clients
+
+    Each job starts from the configuration the service was started with, and
+    may override any of it with its own parameters. Values generated at run
+    time, like the deployment name and the builder VM password, are generated
+    again for each job.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.clients = AzureClientCache()
+        self.templates = {}
+
+    def prepare(self, action, parameters):
+        """Validate a submitted job; return (subscription, config, description)"""
+        jobconfig = self.config.forjob(action, parameters)
+        description = {
+            k: '********' if 'password' in k or 'key' in k else v
+            for k, v in parameters.items()}
+        return jobconfig.subscription_id, jobconfig, description
+
+    def template(self, path):
+        # Reload the template if it changes while the service is running
+        key = (path, os.path.getmtime(path))
+        if key not in self.templates:
+            self.templates[key] = loadtemplate(path)[1]
+        return self.templates[key]
+
+    def run(self, jobconfig):
+        wtlazwrapper = CachedWinTrialLabAzureWrapper(
+            self.clients,
+            jobconfig.service_principal_id,
+            jobconfig.service_principal_key,
+            jobconfig.tenant,
+            jobconfig.subscription_id,
+            jobconfig.resource_group_name,
+            getattr(jobconfig, 'opinsights_workspace_name', None))
+        template = None
+        if jobconfig.action == 'deploy' or jobconfig.action == 'validate':
+            template = self.template(jobconfig.arm_template)
+        return runjob(jobconfig, wtlazwrapper, template)
+
+    def serve(self):
+        queue = deployservice.JobQueue(
+            self.run, maxjobs=self.config.max_jobs,
+            maxpersubscription=self.config.max_jobs_per_subscription)
+        token = deployservice.createtoken(self.config.service_token_file)
+        server = deployservice.JobServer(
+            deployservice.parseaddress(self.config.service_address), queue, self.prepare, token)
+        queue.start()
+        log.warning(f"Listening on {self.config.service_address}; the client token is in {self.config.service_token_file}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            log.warning("Shutting down; waiting for running jobs to finish")
+        finally:
+            server.server_close()
+            queue.stop()
+
+
 class ProcessedDeployConfig:
     """A class that can parse arguments and read from a config file
 
@@ -431,7 +679,20 @@ class ProcessedDeployConfig:
     config_value_types = {
         'debug': 'boolean',
         'delete': 'boolean',
-        'pass_length': 'int'}
+        'all_groups': 'boolean',
+        'pass_length': 'int',
+        'search_limit': 'int',
+        'max_jobs': 'int',
+        'max_jobs_per_subscription': 'int'}
+
+    # Actions that the deploy service can run as jobs
+    serviceactions = ['deploy', 'validate', 'delete', 'testgroup', 'log', 'logsync']
+
+    # Options that only make sense for the client or the service itself,
+    # which a job may not override
+    clientonly = [
+        'action', 'configfile', 'showconfig', 'debug', 'job_action', 'job_id', 'wait',
+        'service_address', 'service_token_file', 'max_jobs', 'max_jobs_per_subscription']
 
     def __init__(self, *args, **kwargs):
 
@@ -447,6 +708,10 @@ class ProcessedDeployConfig:
         # unpassed arguments. All I do here is remove those None options.
         parseddict = {k: v for k, v in parsed.__dict__.items() if v is not None}
 
+        # Keep the options passed on the command line, so that 'submit' can
+        # send just those to the deploy service
+        self.cliargs = parseddict
+
         # Grab configuration from default config files as well as the one passed
         # on the commandline (if present)
         configdict = self.parseconfig([parsed.configfile])
@@ -541,12 +806,67 @@ class ProcessedDeployConfig:
         logopts = argparse.ArgumentParser(add_help=False)
         logopts.add_argument('--query')
 
+        # Options for all subcommands dealing with the local event store
+        eventstoreopts = argparse.ArgumentParser(add_help=False)
+        eventstoreopts.add_argument(
+            '--event-store',
+            help="The path to the local SQLite event store")
+
+        # Options for the logsync subcommand
+        logsyncopts = argparse.ArgumentParser(add_help=False)
+        logsyncopts.add_argument(
+            '--logsync-query',
+            help="The Log Analytics query that selects the event records to save locally")
+
+        # Options for the logsearch subcommand
+        def isodate(value):
+            return datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%S' if 'T' in value else '%Y-%m-%d')
+        logsearchopts = argparse.ArgumentParser(add_help=False)
+        logsearchopts.add_argument(
+            '--all-groups', action='store_const', const=True,
+            help="Search events from every resource group, not just --resource-group-name")
+        logsearchopts.add_argument('--search-deployment-name', help="Only find events from this deployment")
+        logsearchopts.add_argument(
+            '--search-source', help="Only find events from this source; may use SQL LIKE wildcards like 'WinTrialLab%%'")
+        logsearchopts.add_argument('--search-event-id', type=int, help="Only find events with this ID")
+        logsearchopts.add_argument('--search-text', help="Only find events whose message contains this text")
+        logsearchopts.add_argument(
+            '--since', type=isodate, help="Only find events at or after this UTC time, like 2017-09-01 or 2017-09-01T12:00:00")
+        logsearchopts.add_argument('--until', type=isodate, help="Only find events at or before this UTC time")
+        logsearchopts.add_argument('--search-limit', type=int, help="Return at most this many events")
+
         # Options for the genpass subcommand
         genpassopts = argparse.ArgumentParser(add_help=False)
         genpassopts.add_argument(
             '--pass-length', default=24, type=int,
             help='Length of the passphrase to generate.')
 
+        # Options for all subcommands dealing with the deploy service
+        serviceopts = argparse.ArgumentParser(add_help=False)
+        serviceopts.add_argument(
+            '--service-address', help="The host:port the deploy service listens on")
+        serviceopts.add_argument(
+            '--service-token-file', type=QualifiedPath.Resolved(),
+            help="The file where the deploy service saves the token that clients must present")
+
+        # Options for the serve subcommand
+        serveopts = argparse.ArgumentParser(add_help=False)
+        serveopts.add_argument('--max-jobs', type=int, help="The most jobs to run at once")
+        serveopts.add_argument(
+            '--max-jobs-per-subscription', type=int, help="The most jobs to run at once against any one subscription")
+
+        # Options for the submit subcommand
+        submitopts = argparse.ArgumentParser(add_help=False)
+        submitopts.add_argument(
+            'job_action', choices=self.serviceactions, help="The action for the deploy service to run")
+        submitopts.add_argument(
+            '--wait', action='store_const', const=True,
+            help="Wait for the job to finish, and print its result")
+
+        # Options for the jobs subcommand
+        jobsopts = argparse.ArgumentParser(add_help=False)
+        jobsopts.add_argument('job_id', nargs='?', help="Show only this job")
+
         # Configure subcommands
         subparsers = parser.add_subparsers(dest="action")
         subparsers.add_parser(
@@ -569,8 +889,26 @@ class ProcessedDeployConfig:
         subparsers.add_parser(
             'log', parents=[azurecredopts, azurergopts, logopts],
             help='Query the Azure Operational Insights log analytics service')
+        subparsers.add_parser(
+            'logsync', parents=[azurecredopts, azurergopts, eventstoreopts, logsyncopts],
+            help='Save event records from the Azure Operational Insights workspace to the local event store')
+        subparsers.add_parser(
+            'logsearch', parents=[azurergopts, eventstoreopts, logsearchopts],
+            help='Search the local event store, without connecting to Azure')
         subparsers.add_parser(
             'genpass', parents=[genpassopts], help='Generate a passphrase')
+        subparsers.add_parser(
+            'serve', parents=[azurecredopts, azurergopts, serviceopts, serveopts],
+            help='Run the deploy service, which runs jobs submitted over HTTP with warm Azure clients')
+        subparsers.add_parser(
+            'submit',
+            parents=[
+                submitopts, serviceopts, templateopts, buildvmcredopts, azurecredopts, azurergopts,
+                deployopts, logopts, eventstoreopts, logsyncopts],
+            help='Submit a job to the deploy service; options passed here override its configuration for this job only')
+        subparsers.add_parser(
+            'jobs', parents=[serviceopts, jobsopts],
+            help='Show the status of jobs in the deploy service')
 
         return parser.parse_args()
 
@@ -597,14 +935,24 @@ class ProcessedDeployConfig:
         here.
         """
 
+        # Remember which values were generated, so that the deploy service
+        # can generate them again for each job
+        self.runtime_defaults = set()
+
         def setifempty(obj, name, default):
-            if not getattr(obj, name):
+            if not getattr(obj, name, None):
                 setattr(obj, name, default)
+                obj.runtime_defaults.add(name)
 
         datestamp = datetime.datetime.now().strftime('%Y-%d-%m-%H-%M-%S')
         setifempty(self, 'builder_vm_admin_password', genpass(self.pass_length))
         setifempty(self, 'arm_template', self.defaulttempl)
         setifempty(self, 'deployment_name', f'wintriallab-{datestamp}')
+        setifempty(self, 'event_store', os.path.join(homedir(), '.wintriallab.events.sqlite'))
+        # Expand the path here rather than with a type= in the argument
+        # parser, so that values from config files are expanded too
+        self.event_store = os.path.realpath(os.path.expanduser(self.event_store))
+        setifempty(self, 'service_token_file', os.path.join(homedir(), '.wintriallab.service.token'))
 
     def check_required_params(self):
         """Check the required parameters
@@ -664,8 +1012,30 @@ class ProcessedDeployConfig:
                 'builder_vm_admin_password',
                 'builder_vm_size',
                 'query']
+        elif self.action == 'logsync':
+            required = [
+                'service_principal_id',
+                'service_principal_key',
+                'tenant',
+                'subscription_id',
+                'resource_group_name',
+                'opinsights_workspace_name',
+                'event_store',
+                'logsync_query']
+        elif self.action == 'logsearch':
+            required = ['event_store', 'search_limit']
         elif self.action == 'genpass':
             required = ['pass_length']
+        elif self.action == 'serve':
+            required = [
+                'service_address',
+                'service_token_file',
+                'max_jobs',
+                'max_jobs_per_subscription']
+        elif self.action == 'submit':
+            required = ['service_address', 'service_token_file', 'job_action']
+        elif self.action == 'jobs':
+            required = ['service_address', 'service_token_file']
         else:
             raise Exception(f"I don't know how to handle an action of '{self.action}'")
 
@@ -673,6 +1043,27 @@ class ProcessedDeployConfig:
             if not hasattr(self, parameter):
                 raise Exception(f"Missing parameter '{parameter}' was not passed on the command line or set as a configuration value")
 
+    def forjob(self, action, parameters):
+        """Return a copy of this configuration for a deploy service job
+
+        action:     one of serviceactions
+        parameters: a dict of configuration values that override ours for
+                    this job only, with underscores like the config file
+        """
+        if action not in self.serviceactions:
+            raise Exception(f"The deploy service cannot run an action called '{action}'")
+        jobconfig = copy.copy(self)
+        for name in self.runtime_defaults:
+            setattr(jobconfig, name, None)
+        for name, value in parameters.items():
+            if name in self.clientonly:
+                raise Exception(f"A job may not set the '{name}' parameter")
+            setattr(jobconfig, name, value)
+        jobconfig.action = action
+        jobconfig.apply_runtime_defaults()
+        jobconfig.check_required_params()
+        return jobconfig
+
 
 def main(*args, **kwargs):
     config = ProcessedDeployConfig(args, kwargs)
@@ -696,11 +1087,7 @@ def main(*args, **kwargs):
         config.resource_group_name,
         config.opinsights_workspace_name)
 
-    with open(config.arm_template) as tf:
-        # Convert to JSON first to ensure that the template we see from
-        # convertyaml is exactly what Azure sees
-        json_template = json.dumps(yaml.load(tf), indent=2)
-        template = json.loads(json_template)
+    json_template, template = loadtemplate(config.arm_template)
 
     def save_json_template(
             dictionary=json_template,
@@ -719,40 +1106,67 @@ def main(*args, **kwargs):
         log.info(f"Generated passphrase: {genpass(config.pass_length)}")
 
     elif config.action == 'testgroup':
-        if wtlazwrapper.testdeployed(config.resource_group_name):
+        if runjob(config, wtlazwrapper, template):
             log.info(f"YES, the resource group '{config.resource_group_name}' is deployed and costing you $$$")
         else:
             log.info(f"NO, the resource group '{config.resource_group_name}' is not present")
 
     elif config.action == 'delete':
-        wtlazwrapper.deletegroup(config.resource_group_name)
+        runjob(config, wtlazwrapper, template)
         log.info(f"Deleted resource group '{config.resource_group_name}'")
 
-    elif config.action == 'deploy' or config.action == 'validate':
-        # Log this here in case the template doesn't deploy completely, but the VM is still up and we can connect to it for debugging
-        log.debug(f"Using builder VM password '{config.builder_vm_admin_password}'")
-        outputs = wtlazwrapper.deploytempl(
-            config.resource_group_name,
-            config.resource_group_location,
-            template,
-            {
-                'storageAccountName':       config.storage_account_name,
-                'opInsightsWorkspaceName':  config.opinsights_workspace_name,
-                'builderVmAdminUsername':   config.builder_vm_admin_username,
-                'builderVmAdminPassword':   config.builder_vm_admin_password,
-                'builderVmSize':            config.builder_vm_size,
-                'builderVmTimeZone':        config.builder_vm_timezone,
-            },
-            config.deployment_name,
-            deletefirst=config.delete,
-            validate=(config.action == 'validate'))
+    elif config.action == 'validate':
+        runjob(config, wtlazwrapper, template)
+        log.info(f"Template validated for resource group '{config.resource_group_name}'")
 
+    elif config.action == 'deploy':
+        outputs = runjob(config, wtlazwrapper, template)
         conninfo = outputs['builderConnectionInformation']['value']
         msg = "Deployment completed. To connect, run connect.py on your Docker *host* machine (not within the container) like so:"
         msg += f"connect.py {conninfo['IPAddress']} {conninfo['Username']} '{conninfo['Password']}'"
+        msg += "\nThe VM may still be running its deployment extension; to wait until it accepts connections first, run:\n"
+        msg += f"readiness.py --connect --username {conninfo['Username']} --password '{conninfo['Password']}' {conninfo['IPAddress']}"
         log.info(msg)
     elif config.action == 'log':
-        log.info(wtlazwrapper.loganalytics.query(config.query))
+        log.info(runjob(config, wtlazwrapper, template))
+    elif config.action == 'logsync':
+        added = runjob(config, wtlazwrapper, template)
+        log.info(f"Saved {added} new event records from '{config.resource_group_name}' to {config.event_store}")
+    elif config.action == 'logsearch':
+        store = eventstore.EventStore(config.event_store)
+        events = store.search(
+            resource_group=None if config.all_groups else config.resource_group_name,
+            deployment_name=getattr(config, 'search_deployment_name', None),
+            source=getattr(config, 'search_source', None),
+            event_id=getattr(config, 'search_event_id', None),
+            start_time=getattr(config, 'since', None),
+            end_time=getattr(config, 'until', None),
+            text=getattr(config, 'search_text', None),
+            limit=config.search_limit)
+        for event in events:
+            message = (event['message'] or '').strip().splitlines()
+            print(f"{event['timestamp']} {event['deployment_name']} {event['source']} {event['event_id']}: {message[0] if message else ''}")
+    elif config.action == 'serve':
+        DeployService(config).serve()
+    elif config.action == 'submit':
+        client = deployservice.JobClient(
+            config.service_address, deployservice.readtoken(config.service_token_file))
+        # store_true options are always False when they're not passed, so
+        # don't let that override the service's configuration
+        parameters = {
+            k: v for k, v in config.cliargs.items()
+            if k not in config.clientonly and v is not False}
+        job = client.submit(config.job_action, parameters)
+        if getattr(config, 'wait', None):
+            job = client.wait(job['id'])
+            print(json.dumps(job, indent=2))
+            return 0 if job['status'] == 'succeeded' else 1
+        print(job['id'])
+    elif config.action == 'jobs':
+        client = deployservice.JobClient(
+            config.service_address, deployservice.readtoken(config.service_token_file))
+        jobid = getattr(config, 'job_id', None)
+        print(json.dumps(client.job(jobid) if jobid else client.jobs(), indent=2))
     else:
         raise Exception(f"I don't know how to process an action called '{config.action}'")
 
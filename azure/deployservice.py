@@ -0,0 +1,301 @@
+import collections
+import datetime
+import http.server
+import json
+import logging
+import os
+import secrets
+import threading
+import time
+import traceback
+import uuid
+
+import requests
+
+
+log = logging.getLogger('deploy-wintriallab-cloud-builder')
+
+
+class Job:
+    """A single job submitted to the service
+
+    payload is whatever the service's prepare() returned for the job, and is
+    handed to its run() unchanged; it never leaves the service.
+    """
+
+    def __init__(self, action, subscription, payload, parameters):
+        self.id = uuid.uuid4().hex
+        self.action = action
+        self.subscription = subscription
+        self.payload = payload
+        self.parameters = parameters
+        self.status = 'queued'
+        self.submitted = datetime.datetime.utcnow()
+        self.started = None
+        self.finished = None
+        self.result = None
+        self.error = None
+
+    @property
+    def done(self):
+        return self.status in ('succeeded', 'failed')
+
+    def todict(self):
+        def isotime(value):
+            return value.isoformat() + 'Z' if value else None
+        return {
+            'id': self.id,
+            'action': self.action,
+            'subscription': self.subscription,
+            'parameters': self.parameters,
+            'status': self.status,
+            'submitted': isotime(self.submitted),
+            'started': isotime(self.started),
+            'finished': isotime(self.finished),
+            'result': self.result,
+            'error': self.error}
+
+
+class JobQueue:
+    """Run jobs on a pool of worker threads, with a per-subscription limit
+
+    Jobs start in the order they were submitted, except that a job whose
+    subscription already has maxpersubscription jobs running waits without
+    holding up jobs for other subscriptions behind it.
+
+    runner:     a callable that takes a Job's payload and returns a
+                JSON-serializable result
+    history:    how many finished jobs to remember for status queries
+    """
+
+    def __init__(self, runner, maxjobs=8, maxpersubscription=2, history=1000):
+        self.runner = runner
+        self.maxjobs = maxjobs
+        self.maxpersubscription = maxpersubscription
+        self.history = history
+        self.condition = threading.Condition()
+        self.pending = collections.deque()
+        self.running = collections.Counter()
+        self.jobs = collections.OrderedDict()
+        self.workers = []
+        self.stopping = False
+
+    def start(self):
+        for index in range(self.maxjobs):
+            worker = threading.Thread(target=self.work, name=f'job-worker-{index}', daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def stop(self):
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+        for worker in self.workers:
+            worker.join()
+
+    def submit(self, action, subscription, payload, parameters={}):
+        job = Job(action, subscription, payload, parameters)
+        with self.condition:
+            self.jobs[job.id] = job
+            self.pending.append(job)
+            self.forget()
+            self.condition.notify_all()
+        log.info(f"Queued {action} job {job.id} for subscription {subscription}")
+        return job
+
+    def forget(self):
+        """Drop the oldest finished jobs beyond the history limit; call with the lock held"""
+        finished = [jid for jid, job in self.jobs.items() if job.done]
+        for jid in finished[:max(0, len(finished) - self.history)]:
+            del self.jobs[jid]
+
+    def get(self, jobid):
+        with self.condition:
+            return self.jobs.get(jobid)
+
+    def list(self):
+        with self.condition:
+            return list(self.jobs.values())
+
+    def nextjob(self):
+        """Wait for a job whose subscription has a free slot, and claim it"""
+        with self.condition:
+            while True:
+                if self.stopping:
+                    return None
+                for job in self.pending:
+                    if self.running[job.subscription] < self.maxpersubscription:
+                        self.pending.remove(job)
+                        self.running[job.subscription] += 1
+                        job.status = 'running'
+                        job.started = datetime.datetime.utcnow()
+                        return job
+                self.condition.wait()
+
+    def work(self):
+        while True:
+            job = self.nextjob()
+            if not job:
+                return
+            log.info(f"Starting {job.action} job {job.id}")
+            try:
+                result = self.runner(job.payload)
+                # Make sure the result can be reported before calling it a success
+                job.result = json.loads(json.dumps(result, default=str))
+                status = 'succeeded'
+            except Exception as exp:
+                log.error(f"{job.action} job {job.id} failed: {exp}")
+                log.debug(traceback.format_exc())
+                job.error = f"{type(exp).__name__}: {exp}"
+                status = 'failed'
+            with self.condition:
+                job.status = status
+                job.finished = datetime.datetime.utcnow()
+                job.payload = None
+                self.running[job.subscription] -= 1
+                self.forget()
+                self.condition.notify_all()
+            log.info(f"Finished {job.action} job {job.id}: {status}")
+
+
+class JobRequestHandler(http.server.BaseHTTPRequestHandler):
+    """The service's HTTP API
+
+    POST /jobs          submit a job: {"action": "...", "parameters": {...}}
+    GET  /jobs          list jobs
+    GET  /jobs/<id>     show one job
+
+    Every request must carry the service token as a bearer token.
+    """
+
+    def sendjson(self, status, body):
+        data = json.dumps(body, indent=2).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def authorized(self):
+        expected = f'Bearer {self.server.token}'
+        if secrets.compare_digest(self.headers.get('Authorization', ''), expected):
+            return True
+        self.sendjson(401, {'error': "Missing or incorrect service token"})
+        return False
+
+    def do_GET(self):
+        if not self.authorized():
+            return
+        path = self.path.rstrip('/').split('/')[1:]
+        if path == ['jobs']:
+            self.sendjson(200, [job.todict() for job in self.server.queue.list()])
+        elif len(path) == 2 and path[0] == 'jobs':
+            job = self.server.queue.get(path[1])
+            if job:
+                self.sendjson(200, job.todict())
+            else:
+                self.sendjson(404, {'error': f"No such job '{path[1]}'"})
+        else:
+            self.sendjson(404, {'error': f"No such endpoint '{self.path}'"})
+
+    def do_POST(self):
+        if not self.authorized():
+            return
+        if self.path.rstrip('/') != '/jobs':
+            self.sendjson(404, {'error': f"No such endpoint '{self.path}'"})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            body = json.loads(self.rfile.read(length).decode() or '{}')
+            action = body['action']
+            parameters = body.get('parameters', {})
+            if not isinstance(parameters, dict):
+                raise ValueError("'parameters' must be an object")
+            subscription, payload, description = self.server.prepare(action, parameters)
+        except Exception as exp:
+            self.sendjson(400, {'error': f"{type(exp).__name__}: {exp}"})
+            return
+        job = self.server.queue.submit(action, subscription, payload, description)
+        self.sendjson(202, job.todict())
+
+    def log_message(self, format, *args):
+        log.debug(f"{self.address_string()} - {format % args}")
+
+
+class JobServer(http.server.ThreadingHTTPServer):
+    """An HTTP server in front of a JobQueue
+
+    prepare:    a callable that takes (action, parameters) and returns a
+                (subscription, payload, description) tuple, where
+                description is what status queries show for the parameters;
+                raise to reject the job
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, queue, prepare, token):
+        super().__init__(address, JobRequestHandler)
+        self.queue = queue
+        self.prepare = prepare
+        self.token = token
+
+
+def createtoken(path):
+    """Generate a new service token and save it where only we can read it"""
+    token = secrets.token_urlsafe(32)
+    # The mode passed to os.open() only applies to new files, so replace any
+    # existing file rather than inheriting its permissions
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    with open(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), 'w') as tf:
+        tf.write(token)
+    return token
+
+
+def readtoken(path):
+    with open(path) as tf:
+        return tf.read().strip()
+
+
+def parseaddress(address):
+    """Convert 'host:port' into a (host, port) tuple"""
+    host, _, port = address.rpartition(':')
+    return (host or '127.0.0.1', int(port))
+
+
+class JobClient:
+    """A thin client for the service's HTTP API"""
+
+    def __init__(self, address, token):
+        host, port = parseaddress(address)
+        self.baseuri = f'http://{host}:{port}'
+        self.headers = {'Authorization': f'Bearer {token}'}
+
+    def request(self, method, path, **kwargs):
+        response = requests.request(method, self.baseuri + path, headers=self.headers, **kwargs)
+        if response.status_code >= 400:
+            try:
+                error = response.json()['error']
+            except Exception:
+                error = response.text
+            raise Exception(f"The deploy service returned {response.status_code}: {error}")
+        return response.json()
+
+    def submit(self, action, parameters):
+        return self.request('POST', '/jobs', json={'action': action, 'parameters': parameters})
+
+    def job(self, jobid):
+        return self.request('GET', f'/jobs/{jobid}')
+
+    def jobs(self):
+        return self.request('GET', '/jobs')
+
+    def wait(self, jobid, interval=2):
+        """Poll a job until it finishes, and return it"""
+        while True:
+            job = self.job(jobid)
+            if job['status'] in ('succeeded', 'failed'):
+                return job
+            time.sleep(interval)
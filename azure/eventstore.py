@@ -0,0 +1,194 @@
+import bisect
+import datetime
+import hashlib
+import json
+import logging
+import re
+import sqlite3
+
+
+log = logging.getLogger('deploy-wintriallab-cloud-builder')
+
+
+# The Log Analytics search API returns timestamps like 2017-09-01T12:34:56.789Z
+# We store them as ISO 8601 UTC strings, which sort correctly as text
+timestampformat = '%Y-%m-%dT%H:%M:%S.%fZ'
+
+
+def normalizetimestamp(value):
+    """Convert a datetime or a Log Analytics timestamp string to our format"""
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo:
+            value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+        return value.strftime(timestampformat)
+    # Some records have 7 fractional digits, but strptime only accepts 6
+    value = re.sub(r'(\.\d{6})\d+', r'\1', value.strip())
+    for informat in ['%Y-%m-%dT%H:%M:%S.%fZ', '%Y-%m-%dT%H:%M:%SZ', '%Y-%m-%dT%H:%M:%S']:
+        try:
+            return datetime.datetime.strptime(value, informat).strftime(timestampformat)
+        except ValueError:
+            pass
+    raise Exception(f"Could not parse timestamp '{value}'")
+
+
+def parseduration(value):
+    """Convert an ISO 8601 duration like ARM's 'PT1H2M3.4567891S' to a timedelta"""
+    match = re.fullmatch(
+        r'P(?:(?P<days>\d+)D)?(?:T(?:(?P<hours>\d+)H)?(?:(?P<minutes>\d+)M)?(?:(?P<seconds>\d+(?:\.\d+)?)S)?)?',
+        value.strip())
+    if not match:
+        raise Exception(f"Could not parse duration '{value}'")
+    return datetime.timedelta(**{unit: float(amount) for unit, amount in match.groupdict().items() if amount})
+
+
+class EventStore:
+    """A local SQLite store of event records from the builder VMs
+
+    The Operational Insights workspace is deleted along with the resource
+    group, so anything we want to look at later has to be copied out first.
+    Records are keyed by resource group and the record's own ID, so syncing
+    the same time range twice is harmless.
+    """
+
+    schema = [
+        """CREATE TABLE IF NOT EXISTS events (
+            id INTEGER PRIMARY KEY,
+            record_id TEXT NOT NULL,
+            resource_group TEXT NOT NULL,
+            deployment_name TEXT,
+            computer TEXT,
+            event_log TEXT,
+            source TEXT,
+            event_id INTEGER,
+            level TEXT,
+            timestamp TEXT NOT NULL,
+            message TEXT,
+            record TEXT NOT NULL,
+            UNIQUE (resource_group, record_id))""",
+        "CREATE INDEX IF NOT EXISTS events_timestamp ON events (timestamp)",
+        "CREATE INDEX IF NOT EXISTS events_group ON events (resource_group, deployment_name, timestamp)",
+        "CREATE INDEX IF NOT EXISTS events_source ON events (source, timestamp)",
+        "CREATE INDEX IF NOT EXISTS events_eventid ON events (event_id, timestamp)",
+    ]
+
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.row_factory = sqlite3.Row
+        with self.connection:
+            for statement in self.schema:
+                self.connection.execute(statement)
+
+    def close(self):
+        self.connection.close()
+
+    @classmethod
+    def recordid(cls, record):
+        """A stable ID for a record, even if the API didn't give it one"""
+        if record.get('id'):
+            return record['id']
+        return hashlib.sha1(json.dumps(record, sort_keys=True).encode()).hexdigest()
+
+    @classmethod
+    def deploymentat(cls, deployments, timestamp):
+        """Find the deployment that was most recently started at a given time
+
+        deployments:    a list of (start timestamp, deployment name) tuples,
+                        sorted by timestamp, with timestamps in our format
+        """
+        index = bisect.bisect_right([d[0] for d in deployments], timestamp)
+        return deployments[index - 1][1] if index else None
+
+    def ingest(self, records, resource_group, deployments=[]):
+        """Add Log Analytics event records to the store; return the number added
+
+        records:        a list of event records from the Log Analytics API
+        resource_group: the resource group the records came from
+        deployments:    a list of (start time, name) tuples for deployments
+                        to the resource group; each record is tagged with the
+                        latest deployment that started before it was logged
+        """
+        deployments = sorted((normalizetimestamp(t), n) for t, n in deployments)
+        rows = []
+        for record in records:
+            timestamp = normalizetimestamp(record['TimeGenerated'])
+            rows.append((
+                self.recordid(record),
+                resource_group,
+                self.deploymentat(deployments, timestamp),
+                record.get('Computer'),
+                record.get('EventLog'),
+                record.get('Source'),
+                record.get('EventID'),
+                record.get('EventLevelName'),
+                timestamp,
+                record.get('RenderedDescription'),
+                json.dumps(record)))
+        with self.connection:
+            before = self.connection.total_changes
+            self.connection.executemany(
+                """INSERT OR IGNORE INTO events (
+                    record_id, resource_group, deployment_name, computer, event_log,
+                    source, event_id, level, timestamp, message, record)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                rows)
+            added = self.connection.total_changes - before
+        log.info(f"Added {added} of {len(rows)} records to {self.path}")
+        return added
+
+    def latest(self, resource_group):
+        """The timestamp of the newest record for a resource group, or None"""
+        row = self.connection.execute(
+            "SELECT MAX(timestamp) FROM events WHERE resource_group = ?",
+            (resource_group,)).fetchone()
+        if not row or not row[0]:
+            return None
+        return datetime.datetime.strptime(row[0], timestampformat)
+
+    def search(
+            self,
+            resource_group=None,
+            deployment_name=None,
+            source=None,
+            event_id=None,
+            start_time=None,
+            end_time=None,
+            text=None,
+            limit=100):
+        """Search the store
+
+        Every argument is optional, and they are combined with AND.
+
+        source:     an exact source name, or a pattern using SQL LIKE syntax
+                    like 'WinTrialLab%' (exact names can use the index)
+        text:       a substring to look for in the event message
+        start_time: a datetime; find events no earlier than this
+        end_time:   a datetime; find events no later than this
+        """
+        clauses = []
+        parameters = []
+        if resource_group:
+            clauses.append("resource_group = ?")
+            parameters.append(resource_group)
+        if deployment_name:
+            clauses.append("deployment_name = ?")
+            parameters.append(deployment_name)
+        if source:
+            clauses.append("source LIKE ?" if '%' in source or '_' in source else "source = ?")
+            parameters.append(source)
+        if event_id is not None:
+            clauses.append("event_id = ?")
+            parameters.append(event_id)
+        if start_time:
+            clauses.append("timestamp >= ?")
+            parameters.append(normalizetimestamp(start_time))
+        if end_time:
+            clauses.append("timestamp <= ?")
+            parameters.append(normalizetimestamp(end_time))
+        if text:
+            clauses.append("message LIKE ?")
+            parameters.append(f'%{text}%')
+        where = ("WHERE " + " AND ".join(clauses)) if clauses else ""
+        query = f"SELECT * FROM events {where} ORDER BY timestamp LIMIT ?"
+        parameters.append(limit)
+        return [dict(row) for row in self.connection.execute(query, parameters)]
@@ -0,0 +1,508 @@
+#!/usr/bin/env python3
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+
+scriptdir = os.path.dirname(os.path.realpath(__file__))
+
+
+def getlogger(name='wintriallab-isocache'):
+    log = logging.getLogger(name)
+    log.setLevel(logging.WARNING)
+    conhandler = logging.StreamHandler()
+    conhandler.setFormatter(logging.Formatter('%(levelname)s: %(asctime)s: %(message)s'))
+    log.addHandler(conhandler)
+    return log
+
+
+log = getlogger()
+
+
+class ChecksumMismatchError(Exception):
+    """A downloaded artifact did not hash to the checksum we expected"""
+    pass
+
+
+def pathtouri(path):
+    """Convert a local path to a file:// URI that Packer understands
+
+    Packer wants forward slashes and three slashes after the scheme, even on
+    Windows, e.g. file:///C:/Users/example/file.iso
+    """
+    path = os.path.abspath(path).replace('\\', '/')
+    if not path.startswith('/'):
+        path = '/' + path
+    return 'file://' + urllib.parse.quote(path, safe='/:')
+
+
+class DownloadLock:
+    """An exclusive lock on one artifact's partial download
+
+    The lock is a file created with O_EXCL, so only one run can hold it even
+    across processes. While it is held, a heartbeat thread keeps touching the
+    file; a lock file that hasn't been touched for staleafter seconds was left
+    behind by a run that died, and is broken.
+    """
+
+    def __init__(self, path, staleafter=300, pollinterval=5):
+        self.path = path
+        self.staleafter = staleafter
+        self.pollinterval = pollinterval
+        self.released = threading.Event()
+        self.heartbeat = None
+
+    def acquire(self):
+        waiting = False
+        while True:
+            try:
+                fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+            except FileExistsError:
+                try:
+                    age = time.time() - os.path.getmtime(self.path)
+                except FileNotFoundError:
+                    continue
+                if age > self.staleafter:
+                    log.warning(f"Breaking stale lock {self.path}, last touched {age:.0f}s ago")
+                    try:
+                        os.remove(self.path)
+                    except FileNotFoundError:
+                        pass
+                    continue
+                if not waiting:
+                    log.warning(f"Waiting for another run to finish downloading (lock file {self.path})")
+                    waiting = True
+                time.sleep(self.pollinterval)
+                continue
+            with os.fdopen(fd, 'w') as lockfile:
+                lockfile.write(str(os.getpid()))
+            break
+        self.released.clear()
+        self.heartbeat = threading.Thread(target=self.beat, daemon=True)
+        self.heartbeat.start()
+
+    def beat(self):
+        while not self.released.wait(self.staleafter / 4):
+            try:
+                os.utime(self.path)
+            except OSError as exp:
+                log.warning(f"Could not touch lock file {self.path}: {exp}")
+
+    def release(self):
+        self.released.set()
+        self.heartbeat.join()
+        os.remove(self.path)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+class ArtifactStore:
+    """A local store of downloaded artifacts, keyed by checksum
+
+    Artifacts live at <root>/<checksum type>/<checksum>, so any number of
+    packerfiles that reference the same ISO share a single copy no matter what
+    URL they download it from. In-progress downloads live under
+    <root>/partial, next to a small JSON file that records which byte ranges
+    have been completed, so that an interrupted download can be resumed, and a
+    lock file, so that concurrent runs that need the same artifact take turns
+    rather than overwriting each other's download.
+    """
+
+    def __init__(self, root):
+        self.root = os.path.realpath(os.path.expanduser(root))
+        self.partialdir = os.path.join(self.root, 'partial')
+        os.makedirs(self.partialdir, exist_ok=True)
+
+    def path(self, checksum_type, checksum):
+        """The path to a completed artifact"""
+        return os.path.join(self.root, checksum_type.lower(), checksum.lower())
+
+    def partialpath(self, checksum_type, checksum):
+        """The path to an incomplete download of an artifact"""
+        return os.path.join(self.partialdir, f'{checksum_type.lower()}-{checksum.lower()}')
+
+    def contains(self, checksum_type, checksum):
+        return os.path.exists(self.path(checksum_type, checksum))
+
+    def commit(self, partial, checksum_type, checksum):
+        """Move a verified download into its final location in the store"""
+        final = self.path(checksum_type, checksum)
+        os.makedirs(os.path.dirname(final), exist_ok=True)
+        os.replace(partial, final)
+        log.info(f"Stored artifact at {final}")
+        return final
+
+    def fetch(self, url, checksum_type, checksum, segments=4):
+        """Return the path to an artifact, downloading it first if necessary"""
+        if self.contains(checksum_type, checksum):
+            log.info(f"Found {checksum_type}:{checksum} in the artifact store")
+            return self.path(checksum_type, checksum)
+        partial = self.partialpath(checksum_type, checksum)
+        with DownloadLock(partial + '.lock'):
+            # Another run may have finished the download while we waited for the lock
+            if self.contains(checksum_type, checksum):
+                log.info(f"Found {checksum_type}:{checksum} in the artifact store")
+                return self.path(checksum_type, checksum)
+            downloader = RangeDownloader(url, partial, checksum_type, segments=segments)
+            digest = downloader.download()
+            if digest.lower() != checksum.lower():
+                downloader.discard()
+                raise ChecksumMismatchError(
+                    f"Downloaded '{url}' but got {checksum_type} checksum '{digest}' instead of '{checksum}'")
+            downloader.cleanup()
+            return self.commit(partial, checksum_type, checksum)
+
+
+class StreamingHasher:
+    """Hash a file that is being written out of order by several threads
+
+    Segments report how far they have written with .advance(). The hasher
+    thread consumes the file strictly in order, hashing each region as soon as
+    every byte before it is present, so the hash is finished a moment after
+    the last segment is and the file never has to be read again afterwards.
+    """
+
+    chunksize = 1024 * 1024
+
+    def __init__(self, path, checksum_type, segments):
+        self.path = path
+        self.hash = hashlib.new(checksum_type)
+        # A list of [start, written-through, end] for each segment, in order
+        self.segments = [[start, start, end] for start, end in segments]
+        self.hashed = 0
+        self.failed = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def advance(self, index, position):
+        with self.condition:
+            self.segments[index][1] = position
+            self.condition.notify()
+
+    def finish(self, index, end):
+        """Record the end of a segment whose length was not known upfront"""
+        with self.condition:
+            self.segments[index][1] = end
+            self.segments[index][2] = end
+            self.condition.notify()
+
+    def abort(self):
+        with self.condition:
+            self.failed = True
+            self.condition.notify()
+
+    @property
+    def available(self):
+        """The offset through which the file is contiguously written"""
+        available = 0
+        for start, written, end in self.segments:
+            if start > available:
+                break
+            available = written
+            if written < end:
+                break
+        return available
+
+    @property
+    def total(self):
+        return self.segments[-1][2] if self.segments else 0
+
+    def run(self):
+        # Unbuffered, so that we never hash stale read-ahead of unwritten bytes
+        with open(self.path, 'rb', buffering=0) as infile:
+            while True:
+                with self.condition:
+                    while (not self.failed and self.hashed < self.total and
+                           self.available <= self.hashed):
+                        self.condition.wait()
+                    if self.failed or self.hashed >= self.total:
+                        return
+                    available = self.available
+                infile.seek(self.hashed)
+                while self.hashed < available:
+                    chunk = infile.read(min(self.chunksize, available - self.hashed))
+                    self.hash.update(chunk)
+                    self.hashed += len(chunk)
+
+    def hexdigest(self):
+        self.thread.join()
+        return self.hash.hexdigest()
+
+
+class RangeDownloader:
+    """Download a URL in several parallel byte ranges
+
+    If the server does not advertise support for range requests, fall back to
+    a single stream. Progress is recorded in a JSON state file next to the
+    download after every chunk, so a later run with the same destination
+    picks up where an earlier one left off.
+    """
+
+    chunksize = 1024 * 1024
+
+    def __init__(self, url, destination, checksum_type, segments=4):
+        self.url = url
+        self.destination = destination
+        self.statefile = destination + '.json'
+        self.checksum_type = checksum_type
+        self.segmentcount = max(1, segments)
+        self.statelock = threading.Lock()
+
+    def probe(self):
+        """Find the length of the resource and whether ranges are supported"""
+        request = urllib.request.Request(self.url, method='HEAD')
+        with urllib.request.urlopen(request) as response:
+            length = response.headers.get('Content-Length')
+            ranges = response.headers.get('Accept-Ranges', '').lower() == 'bytes'
+        return (int(length) if length is not None else None), ranges
+
+    def loadstate(self, length):
+        """Load saved progress, if it belongs to the same download"""
+        try:
+            with open(self.statefile) as sf:
+                state = json.load(sf)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        if state.get('url') != self.url or state.get('length') != length:
+            log.info(f"Ignoring stale download state in {self.statefile}")
+            return None
+        if not os.path.exists(self.destination):
+            return None
+        return state
+
+    def savestate(self, state):
+        with self.statelock:
+            tmp = self.statefile + '.tmp'
+            with open(tmp, 'w') as sf:
+                json.dump(state, sf)
+            os.replace(tmp, self.statefile)
+
+    def newstate(self, length, ranges):
+        if length is None or not ranges or length < self.chunksize:
+            boundaries = [(0, length)]
+        else:
+            size = -(-length // self.segmentcount)
+            boundaries = [
+                (start, min(start + size, length))
+                for start in range(0, length, size)]
+        return {
+            'url': self.url,
+            'length': length,
+            'segments': [
+                {'start': s, 'end': e, 'written': s} for s, e in boundaries]}
+
+    def fetchsegment(self, state, index, hasher, errors):
+        segment = state['segments'][index]
+        if segment['end'] is not None and segment['written'] >= segment['end']:
+            return
+        request = urllib.request.Request(self.url)
+        ranged = len(state['segments']) > 1 or segment['written'] > 0
+        if ranged:
+            end = '' if segment['end'] is None else segment['end'] - 1
+            request.add_header('Range', f"bytes={segment['written']}-{end}")
+        try:
+            with urllib.request.urlopen(request) as response, open(self.destination, 'r+b') as outfile:
+                if ranged and response.status != 206:
+                    raise Exception(f"Server ignored range request for segment {index} of '{self.url}'")
+                outfile.seek(segment['written'])
+                while True:
+                    want = self.chunksize
+                    if segment['end'] is not None:
+                        want = min(want, segment['end'] - segment['written'])
+                        if want <= 0:
+                            break
+                    chunk = response.read(want)
+                    if not chunk:
+                        break
+                    outfile.write(chunk)
+                    outfile.flush()
+                    segment['written'] += len(chunk)
+                    hasher.advance(index, segment['written'])
+                    self.savestate(state)
+            if segment['end'] is None:
+                segment['end'] = segment['written']
+                state['length'] = segment['written']
+                hasher.finish(index, segment['end'])
+            elif segment['written'] < segment['end']:
+                raise Exception(f"Segment {index} of '{self.url}' ended early at byte {segment['written']}")
+        except Exception as exp:
+            errors.append(exp)
+            hasher.abort()
+
+    def download(self):
+        """Download the resource and return its hex digest"""
+        length, ranges = self.probe()
+        state = self.loadstate(length) if ranges else None
+        if state:
+            log.info(f"Resuming download of '{self.url}' from {self.statefile}")
+        else:
+            state = self.newstate(length, ranges)
+            with open(self.destination, 'wb') as outfile:
+                if length:
+                    outfile.truncate(length)
+            self.savestate(state)
+
+        segments = state['segments']
+        # For unknown lengths, the hasher learns the final end once the stream finishes
+        hasher = StreamingHasher(
+            self.destination, self.checksum_type,
+            [(s['start'], s['end'] if s['end'] is not None else float('inf')) for s in segments])
+        for index, segment in enumerate(segments):
+            hasher.segments[index][1] = segment['written']
+        hasher.start()
+
+        log.info(f"Downloading '{self.url}' in {len(segments)} segment(s)")
+        errors = []
+        threads = [
+            threading.Thread(target=self.fetchsegment, args=(state, i, hasher, errors))
+            for i in range(len(segments))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0]
+        return hasher.hexdigest()
+
+    def cleanup(self):
+        """Remove the state file once the download is complete"""
+        if os.path.exists(self.statefile):
+            os.remove(self.statefile)
+
+    def discard(self):
+        """Throw away a bad download entirely"""
+        self.cleanup()
+        if os.path.exists(self.destination):
+            os.remove(self.destination)
+
+
+class CachedPackerfile:
+    """A packerfile whose ISOs are served from an ArtifactStore
+
+    Packerfiles either set iso_url/iso_checksum/iso_checksum_type as user
+    variables (and reference them from each builder), or set them on each
+    builder directly. In the first case we can just pass -var arguments to
+    packer; in the second, we write a rewritten copy of the packerfile next to
+    the original, so that relative paths like floppy_files still resolve.
+    """
+
+    def __init__(self, path, store):
+        self.path = os.path.realpath(path)
+        self.store = store
+        with open(self.path) as pf:
+            self.packerfile = json.load(pf)
+
+    @property
+    def variables(self):
+        return self.packerfile.get('variables', {})
+
+    def isos(self):
+        """Return a list of (url, checksum_type, checksum) tuples"""
+        isos = []
+        if 'iso_url' in self.variables:
+            isos.append((
+                self.variables['iso_url'],
+                self.variables['iso_checksum_type'],
+                self.variables['iso_checksum']))
+        for builder in self.packerfile.get('builders', []):
+            url = builder.get('iso_url', '')
+            if url and '{{' not in url:
+                isos.append((url, builder['iso_checksum_type'], builder['iso_checksum']))
+        return list(dict.fromkeys(isos))
+
+    def fetch(self, segments=4):
+        """Make sure every ISO is in the store; return a map of URL to file:// URI"""
+        return {
+            url: pathtouri(self.store.fetch(url, ctype, csum, segments=segments))
+            for url, ctype, csum in self.isos()}
+
+    def packerargs(self, segments=4):
+        """Return (packerfile path, extra arguments) for a cached packer build"""
+        cached = self.fetch(segments=segments)
+        arguments = []
+        if 'iso_url' in self.variables:
+            arguments += ['-var', f"iso_url={cached[self.variables['iso_url']]}"]
+
+        rewrite = False
+        rewritten = json.loads(json.dumps(self.packerfile))
+        for builder in rewritten.get('builders', []):
+            if builder.get('iso_url') in cached:
+                builder['iso_url'] = cached[builder['iso_url']]
+                rewrite = True
+        if not rewrite:
+            return self.path, arguments
+
+        packerfile = os.path.splitext(self.path)[0] + '.isocache.json'
+        with open(packerfile, 'w') as pf:
+            json.dump(rewritten, pf, indent=2)
+        log.info(f"Wrote packerfile with cached ISO paths to {packerfile}")
+        return packerfile, arguments
+
+
+def main(*args, **kwargs):
+    parser = argparse.ArgumentParser(
+        description="Download ISOs to a local, checksum-keyed artifact store and run packer against the cached copies")
+    parser.add_argument('--debug', '-d', action='store_true')
+    parser.add_argument(
+        '--store', default=os.path.join(tempfile.gettempdir(), 'wintriallab-isocache'),
+        help="The root of the artifact store")
+    parser.add_argument(
+        '--segments', type=int, default=4,
+        help="The number of parallel range requests to use per download")
+    subparsers = parser.add_subparsers(dest="action")
+    subparsers.required = True
+
+    fetchparser = subparsers.add_parser('fetch', help="Download an artifact into the store")
+    fetchparser.add_argument('url')
+    fetchparser.add_argument('checksum_type')
+    fetchparser.add_argument('checksum')
+
+    buildparser = subparsers.add_parser(
+        'build', help="Fetch the ISOs for a packerfile, then run 'packer build' against the cached copies")
+    buildparser.add_argument('packerfile')
+    buildparser.add_argument(
+        'packerargs', nargs=argparse.REMAINDER,
+        help="Any further arguments are passed to 'packer build'")
+
+    parsed = parser.parse_args()
+
+    if parsed.debug:
+        log.setLevel(logging.DEBUG)
+
+    store = ArtifactStore(parsed.store)
+
+    if parsed.action == 'fetch':
+        print(store.fetch(parsed.url, parsed.checksum_type, parsed.checksum, segments=parsed.segments))
+    elif parsed.action == 'build':
+        packer = shutil.which('packer')
+        if not packer:
+            raise Exception("Could not find packer in the PATH")
+        packerfile, arguments = CachedPackerfile(parsed.packerfile, store).packerargs(segments=parsed.segments)
+        command = [packer, 'build'] + arguments + parsed.packerargs + [packerfile]
+        log.info("Running command: " + ' '.join(command))
+        return subprocess.call(command, cwd=os.path.dirname(packerfile))
+    else:
+        raise Exception(f"I don't know how to process an action called '{parsed.action}'")
+
+
+if __name__ == '__main__':
+    sys.exit(main(*sys.argv))
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import collections
+import json
+import logging
+import random
+import sys
+import time
+
+import connect
+
+
+def getlogger(name='wintriallab-cloud-builder-readiness'):
+    log = logging.getLogger(name)
+    log.setLevel(logging.WARNING)
+    conhandler = logging.StreamHandler()
+    conhandler.setFormatter(logging.Formatter('%(levelname)s: %(asctime)s: %(message)s'))
+    log.addHandler(conhandler)
+    return log
+
+
+log = getlogger()
+
+
+# A host is ready when at least one port from every group accepts connections:
+# RDP, and WinRM over either HTTP or HTTPS
+defaultrequirements = [(3389,), (5985, 5986)]
+
+# Remote Desktop only needs RDP, and the template doesn't open WinRM
+connectrequirements = [(3389,)]
+
+
+HostReadiness = collections.namedtuple('HostReadiness', ['host', 'ready', 'openports', 'elapsed', 'attempts'])
+
+
+async def probeport(host, port, timeout=5):
+    """Return True if a TCP connection to host:port succeeds"""
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+    except (OSError, asyncio.TimeoutError):
+        return False
+    writer.close()
+    try:
+        await writer.wait_closed()
+    except OSError:
+        pass
+    return True
+
+
+async def waitforhost(
+        host,
+        requirements=defaultrequirements,
+        timeout=1800,
+        initialdelay=1,
+        maxdelay=30,
+        connecttimeout=5):
+    """Poll a host with exponential backoff until it meets every requirement
+
+    requirements:   a list of port groups; the host is ready once at least one
+                    port in every group accepts a connection
+    timeout:        give up after this many seconds
+
+    Returns a HostReadiness tuple.
+    """
+    ports = sorted({port for group in requirements for port in group})
+    start = time.monotonic()
+    delay = initialdelay
+    attempts = 0
+    while True:
+        attempts += 1
+        results = await asyncio.gather(*[probeport(host, p, connecttimeout) for p in ports])
+        openports = {port for port, isopen in zip(ports, results) if isopen}
+        elapsed = time.monotonic() - start
+        if all(openports.intersection(group) for group in requirements):
+            log.info(f"{host} is ready after {elapsed:.1f}s with ports {sorted(openports)} open")
+            return HostReadiness(host, True, sorted(openports), elapsed, attempts)
+        if elapsed + delay > timeout:
+            log.warning(f"{host} was not ready after {elapsed:.1f}s; open ports: {sorted(openports)}")
+            return HostReadiness(host, False, sorted(openports), elapsed, attempts)
+        log.debug(f"{host} not ready yet (open ports: {sorted(openports)}), retrying in {delay:.1f}s")
+        await asyncio.sleep(delay)
+        # Jitter keeps a fleet of probes from retrying in lockstep
+        delay = min(maxdelay, delay * 2) * random.uniform(0.8, 1.0)
+
+
+async def waitforhosts(hosts, **kwargs):
+    """Wait for many hosts concurrently; return a list of HostReadiness"""
+    return await asyncio.gather(*[waitforhost(host, **kwargs) for host in hosts])
+
+
+def loadconninfo(path):
+    """Load builderConnectionInformation output(s) from a JSON file
+
+    Accepts a single output object, a list of them, or the whole outputs
+    dict from a deployment, with or without ARM's {'value': ...} wrappers.
+    Use '-' to read from stdin.
+    """
+    if path == '-':
+        data = json.load(sys.stdin)
+    else:
+        with open(path) as cf:
+            data = json.load(cf)
+    if isinstance(data, dict) and 'builderConnectionInformation' in data:
+        data = data['builderConnectionInformation']
+    if isinstance(data, dict) and 'value' in data:
+        data = data['value']
+    if isinstance(data, dict):
+        data = [data]
+    return [item.get('value', item) for item in data]
+
+
+def parserequirements(groups):
+    """Convert arguments like ['3389', '5985,5986'] into port groups"""
+    return [tuple(int(port) for port in group.split(',')) for group in groups]
+
+
+def main(*args, **kwargs):
+    parser = argparse.ArgumentParser(
+        description="Wait until cloud builder VMs accept RDP and WinRM connections")
+    parser.add_argument('--debug', '-d', action='store_true')
+    parser.add_argument(
+        '--conninfo', '-c',
+        help="A JSON file containing builderConnectionInformation deployment output(s), or '-' for stdin")
+    parser.add_argument(
+        '--require', '-r', action='append',
+        help="A comma-separated group of ports, at least one of which must be open. May be passed more than once. Defaults to '3389' and '5985,5986', or just '3389' with --connect.")
+    parser.add_argument('--timeout', type=int, default=1800, help="Seconds to wait for each host")
+    parser.add_argument('--max-delay', type=int, default=30, help="The longest to wait between probes, in seconds")
+    parser.add_argument(
+        '--connect', action='store_true',
+        help="Once a single host is ready, connect to it with Remote Desktop. Requires --conninfo, or --username and --password.")
+    parser.add_argument('--username', help="Remote username, for --connect")
+    parser.add_argument('--password', help="Remote password, for --connect")
+    parser.add_argument('hosts', nargs='*', help="Hostnames or IP addresses to probe")
+    parsed = parser.parse_args()
+
+    if parsed.debug:
+        log.setLevel(logging.DEBUG)
+
+    conninfos = loadconninfo(parsed.conninfo) if parsed.conninfo else []
+    if parsed.username and parsed.password:
+        conninfos += [
+            {'IPAddress': host, 'Username': parsed.username, 'Password': parsed.password}
+            for host in parsed.hosts]
+    hosts = list(dict.fromkeys([ci['IPAddress'] for ci in conninfos] + parsed.hosts))
+    if not hosts:
+        raise Exception("Pass at least one host, or a --conninfo file")
+    if parsed.require:
+        requirements = parserequirements(parsed.require)
+    elif parsed.connect:
+        requirements = connectrequirements
+    else:
+        requirements = defaultrequirements
+
+    results = asyncio.run(waitforhosts(
+        hosts, requirements=requirements, timeout=parsed.timeout, maxdelay=parsed.max_delay))
+
+    for result in results:
+        status = "READY" if result.ready else "NOT READY"
+        print(f"{result.host}: {status} after {result.elapsed:.1f}s ({result.attempts} attempts), open ports: {result.openports}")
+    if not all(result.ready for result in results):
+        return 1
+
+    if parsed.connect:
+        if len(conninfos) != 1 or len(hosts) != 1:
+            raise Exception("--connect requires exactly one host, along with its credentials")
+        conninfo = conninfos[0]
+        if sys.platform == "win32":
+            connect.rdp_win(conninfo['IPAddress'], conninfo['Username'], conninfo['Password'])
+        elif sys.platform == "darwin":
+            connect.cord_mac(conninfo['IPAddress'], conninfo['Username'], conninfo['Password'])
+        else:
+            raise Exception(
+                f"No RDP connector configured for platform '{sys.platform}'")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(*sys.argv))
@@ -21,10 +21,10 @@ catch {}
 
 Invoke-ScriptblockAndCatch -scriptBlock {
     Write-EventLogWrapper "PostInstall for packer build '$packerBuildName' of type '$packerBuilderType'"
-    Install-SevenZip
+    Invoke-BuildStep -name Install-SevenZip -scriptBlock { Install-SevenZip }
     Set-AutoAdminLogon -Disable
     Enable-RDP
-    Install-Chocolatey
+    Invoke-BuildStep -name Install-Chocolatey -scriptBlock { Install-Chocolatey }
 
     $suoParams = @{ 
         ShowHiddenFiles = $true
@@ -37,8 +37,9 @@ Invoke-ScriptblockAndCatch -scriptBlock {
         DisableSystrayHide = $true
         DisableIEFirstRunCustomize = $true
     }
-    Set-UserOptions @suoParams
+    Invoke-BuildStep -name Set-UserOptions -scriptBlock { Set-UserOptions @suoParams }
 
-    #Install-CompiledDotNetAssemblies   # Takes about 15 minutes for me 
-    #Compress-WindowsInstall            # Takes maybe another 15 minutes
+    # Run azure/buildprofile.py against the event logs of builds with and without these to see what they cost
+    #Invoke-BuildStep -name Install-CompiledDotNetAssemblies -scriptBlock { Install-CompiledDotNetAssemblies }  # Takes about 15 minutes for me
+    #Invoke-BuildStep -name Compress-WindowsInstall -scriptBlock { Compress-WindowsInstall }                    # Takes maybe another 15 minutes
 }